@@ -48,6 +48,17 @@ const AdvancedOptionsEditor = ({
   const [languageModel, setLanguageModel] = useState<string>(
     advancedOptions.languageModel,
   );
+  const [isApproximateSearchEnabled, setIsApproximateSearchEnabled] =
+    useState(advancedOptions.neighborSearch === "ivf");
+  const [isOnnxBackendEnabled, setIsOnnxBackendEnabled] = useState(
+    advancedOptions.embeddingBackend === "onnx_int8",
+  );
+  const [isTopNSimilaritiesEnabled, setIsTopNSimilaritiesEnabled] = useState(
+    advancedOptions.similaritiesFormat === "top_n",
+  );
+  const [similaritiesTopN, setSimilaritiesTopN] = useState<number>(
+    advancedOptions.similaritiesTopN ?? 10,
+  );
 
   const handleSave = () => {
     console.log("Saving advanced options...");
@@ -62,12 +73,20 @@ const AdvancedOptionsEditor = ({
       localSimilarityThreshold = null;
     }
     setAdvancedOptions({
+      ...advancedOptions,
       outlierDetection: isOutlierDetectionEnabled,
       agglomerativeClustering: isAgglomerativeClusteringEnabled,
       nearestNeighbors: localNearestNeighbors,
       zScoreThreshold: localZScoreThreshold,
       similarityThreshold: localSimilarityThreshold,
       languageModel,
+      neighborSearch: isApproximateSearchEnabled ? "ivf" : "exact",
+      embeddingBackend: isOnnxBackendEnabled ? "onnx_int8" : "torch",
+      similaritiesFormat: isTopNSimilaritiesEnabled ? "top_n" : "full",
+      // a cleared field is NaN, which would be sent as null
+      similaritiesTopN: Number.isNaN(similaritiesTopN)
+        ? 10
+        : Math.max(1, Math.round(similaritiesTopN)),
     });
     setUnsavedChanges(false);
     setIsOpen(false);
@@ -173,6 +192,16 @@ const AdvancedOptionsEditor = ({
                     disabled={!isOutlierDetectionEnabled}
                   />
                 </div>
+                <div className="flex items-center justify-between">
+                  <p>Approximate neighbor search (for very large files)</p>
+                  <Toggle
+                    initialState={isApproximateSearchEnabled}
+                    onToggle={() => {
+                      setIsApproximateSearchEnabled((prev) => !prev);
+                      setUnsavedChanges(true);
+                    }}
+                  />
+                </div>
               </div>
             </TooltipTrigger>
             <TooltipContent>
@@ -185,6 +214,10 @@ const AdvancedOptionsEditor = ({
                   neighbors of each data point and flags data points that are
                   more than <span className="font-bold">{zScoreThreshold}</span>{" "}
                   standard deviations away from the average.
+                  <br></br>
+                  The approximate neighbor search only compares similar
+                  responses and is much faster for hundreds of thousands of
+                  responses, at the cost of occasionally missing a neighbor.
                 </p>
               </TooltipContentContainer>
             </TooltipContent>
@@ -238,6 +271,55 @@ const AdvancedOptionsEditor = ({
               />
             </div>
           </div>
+          <Tooltip>
+            <TooltipTrigger asChild>
+              <div className="flex items-center justify-between">
+                <p>Only save the most similar clusters</p>
+                <Toggle
+                  initialState={isTopNSimilaritiesEnabled}
+                  onToggle={() => {
+                    setIsTopNSimilaritiesEnabled((prev) => !prev);
+                    setUnsavedChanges(true);
+                  }}
+                />
+              </div>
+            </TooltipTrigger>
+            <TooltipContent>
+              <TooltipContentContainer
+                tutorialMode={tutorialState.tutorialMode}
+              >
+                <p className="text-left">
+                  By default the similarities between all pairs of clusters are
+                  saved, which becomes slow to load for hundreds of clusters.
+                  <br></br>
+                  If enabled, only the{" "}
+                  <span className="font-bold">{similaritiesTopN}</span> most
+                  similar clusters of every cluster are saved.
+                </p>
+              </TooltipContentContainer>
+            </TooltipContent>
+          </Tooltip>
+          <div
+            className={`flex flex-col gap-1 pl-4 ${!isTopNSimilaritiesEnabled && "text-gray-400"}`}
+          >
+            <div className="flex items-center justify-between">
+              <label htmlFor="similaritiesTopN">
+                <p>Number of most similar clusters to save</p>
+              </label>
+              <input
+                type="number"
+                id="similaritiesTopN"
+                min={1}
+                value={similaritiesTopN}
+                onChange={(e) => {
+                  setSimilaritiesTopN(e.target.valueAsNumber);
+                  setUnsavedChanges(true);
+                }}
+                className="w-20 rounded-md border border-gray-300 p-2 text-center focus:outline-none focus:ring focus:ring-primaryColor focus:ring-opacity-50 dark:bg-backgroundColor"
+                disabled={!isTopNSimilaritiesEnabled}
+              />
+            </div>
+          </div>
           <Tooltip>
             <TooltipTrigger asChild>
               <div className="flex items-center justify-between">
@@ -275,6 +357,34 @@ const AdvancedOptionsEditor = ({
               </TooltipContentContainer>
             </TooltipContent>
           </Tooltip>
+          <Tooltip>
+            <TooltipTrigger asChild>
+              <div className="flex items-center justify-between">
+                <p>Quantized language model (faster on CPU)</p>
+                <Toggle
+                  initialState={isOnnxBackendEnabled}
+                  onToggle={() => {
+                    setIsOnnxBackendEnabled((prev) => !prev);
+                    setUnsavedChanges(true);
+                  }}
+                />
+              </div>
+            </TooltipTrigger>
+            <TooltipContent>
+              <TooltipContentContainer
+                tutorialMode={tutorialState.tutorialMode}
+              >
+                <p className="text-left">
+                  Runs an 8-bit version of the language model with ONNX
+                  Runtime, which embeds responses several times faster on
+                  computers without a graphics card.
+                  <br></br>
+                  The model is converted once on first use. The embeddings
+                  differ slightly from the full-precision model.
+                </p>
+              </TooltipContentContainer>
+            </TooltipContent>
+          </Tooltip>
         </div>
         <div className="flex justify-end p-4">
           <Button
@@ -81,22 +81,82 @@ const ClusterDetails: React.FC<{ cluster: Cluster | undefined }> = ({
   );
 };
 
+// the most similar clusters of every cluster sorted descendingly, and the
+// similarity of every saved pair keyed by pairKey(), so both lookups take
+// constant time regardless of the number of clusters
+interface ClusterSimilarityIndex {
+  mostSimilar: Map<number, ClusterSimilarity[]>;
+  pairs: Map<string, number>;
+  topN: number | null;
+}
+
+const pairKey = (index1: number, index2: number) =>
+  index1 < index2 ? `${index1}-${index2}` : `${index2}-${index1}`;
+
+const buildSimilarityIndex = (
+  similarityUnknown: unknown,
+  similaritiesFormat: "full" | "top_n",
+): ClusterSimilarityIndex => {
+  const mostSimilar = new Map<number, ClusterSimilarity[]>();
+  const pairs = new Map<string, number>();
+  if (similaritiesFormat === "top_n") {
+    const similarity = similarityUnknown as {
+      topN: number;
+      clusters: [number, number][][];
+    };
+    similarity.clusters.forEach((neighbors, cluster1) => {
+      mostSimilar.set(
+        cluster1,
+        neighbors.map(([cluster2, sim]) => {
+          pairs.set(pairKey(cluster1, cluster2), sim);
+          return { cluster1, cluster2, similarity: sim };
+        }),
+      );
+    });
+    return { mostSimilar, pairs, topN: similarity.topN };
+  }
+  const similarity = similarityUnknown as Record<
+    string,
+    Record<string, number>
+  >;
+  for (const cluster1 in similarity) {
+    const clusterSimilarities: ClusterSimilarity[] = [];
+    for (const cluster2 in similarity[cluster1]) {
+      const sim = similarity[cluster1][cluster2];
+      pairs.set(pairKey(parseInt(cluster1), parseInt(cluster2)), sim);
+      clusterSimilarities.push({
+        cluster1: parseInt(cluster1),
+        cluster2: parseInt(cluster2),
+        similarity: sim,
+      });
+    }
+    clusterSimilarities.sort((a, b) => b.similarity - a.similarity);
+    mostSimilar.set(parseInt(cluster1), clusterSimilarities);
+  }
+  return { mostSimilar, pairs, topN: null };
+};
+
 function ClusterSimilarityModal({
   similaritiesPath,
+  similaritiesFormat = "full",
   clusterAssignmentsPath,
   delimiter,
   isOpen,
   setIsOpen,
 }: {
   similaritiesPath: string;
+  similaritiesFormat?: "full" | "top_n";
   clusterAssignmentsPath: string;
   delimiter: string;
   isOpen: boolean;
   setIsOpen: (isOpen: boolean) => void;
 }) {
-  const [clusterSimilarities, setClusterSimilarities] = useState<
-    ClusterSimilarity[]
-  >([]);
+  const [similarityIndex, setSimilarityIndex] =
+    useState<ClusterSimilarityIndex>({
+      mostSimilar: new Map(),
+      pairs: new Map(),
+      topN: null,
+    });
   const [clusters, setClusters] = useState<Cluster[]>([]);
   const [selectedClusterIndex, setSelectedClusterIndex] = useState<
     number | undefined
@@ -122,21 +182,9 @@ function ClusterSimilarityModal({
 
   useEffect(() => {
     window.python.readJsonFile(similaritiesPath).then((similarityUnknown) => {
-      const similarity = similarityUnknown as Record<
-        string,
-        Record<string, number>
-      >;
-      const clusterSimilarities: ClusterSimilarity[] = [];
-      for (const cluster1 in similarity) {
-        for (const cluster2 in similarity[cluster1]) {
-          clusterSimilarities.push({
-            cluster1: parseInt(cluster1),
-            cluster2: parseInt(cluster2),
-            similarity: similarity[cluster1][cluster2],
-          });
-        }
-      }
-      setClusterSimilarities(clusterSimilarities);
+      setSimilarityIndex(
+        buildSimilarityIndex(similarityUnknown, similaritiesFormat),
+      );
     });
 
     const fetchClusterAssignments = async () => {
@@ -183,29 +231,25 @@ function ClusterSimilarityModal({
     };
 
     fetchClusterAssignments();
-  }, [similaritiesPath, clusterAssignmentsPath, delimiter]);
+  }, [
+    similaritiesPath,
+    similaritiesFormat,
+    clusterAssignmentsPath,
+    delimiter,
+  ]);
 
   const getClusterSimilarity = useCallback(
     (index1: number, index2: number) => {
-      return (
-        clusterSimilarities.find(
-          (cs) =>
-            (cs.cluster1 === index1 && cs.cluster2 === index2) ||
-            (cs.cluster1 === index2 && cs.cluster2 === index1),
-        )?.similarity || 0
-      );
+      return similarityIndex.pairs.get(pairKey(index1, index2));
     },
-    [clusterSimilarities],
+    [similarityIndex],
   );
 
   const getMostSimilarClusters = useCallback(
     (clusterId: number, count = 5) => {
-      return clusterSimilarities
-        .filter((cs) => cs.cluster1 === clusterId)
-        .sort((a, b) => b.similarity - a.similarity)
-        .slice(0, count);
+      return (similarityIndex.mostSimilar.get(clusterId) ?? []).slice(0, count);
     },
-    [clusterSimilarities],
+    [similarityIndex],
   );
 
   const handleKeyDown = (event: KeyboardEvent) => {
@@ -649,27 +693,41 @@ function ClusterSimilarityModal({
                         )}
                       </div>
                       <div className="mt-2 rounded bg-white p-4 shadow-md dark:bg-zinc-900">
-                        <div className="flex justify-between">
-                          <p>Similarity:</p>
+                        {getClusterSimilarity(
+                          selectedClusterIndex,
+                          comparisonClusterIndex,
+                        ) === undefined ? (
                           <p>
-                            {(
-                              getClusterSimilarity(
-                                selectedClusterIndex,
-                                comparisonClusterIndex,
-                              ) * 100
-                            ).toFixed(2)}
-                            %
+                            Neither cluster is among the {similarityIndex.topN}{" "}
+                            most similar clusters of the other.
                           </p>
-                        </div>
-                        <div className="flex items-center">
-                          <SimilarityVisualizer
-                            similarity={getClusterSimilarity(
-                              selectedClusterIndex,
-                              comparisonClusterIndex,
-                            )}
-                            primary={true}
-                          />
-                        </div>
+                        ) : (
+                          <>
+                            <div className="flex justify-between">
+                              <p>Similarity:</p>
+                              <p>
+                                {(
+                                  (getClusterSimilarity(
+                                    selectedClusterIndex,
+                                    comparisonClusterIndex,
+                                  ) ?? 0) * 100
+                                ).toFixed(2)}
+                                %
+                              </p>
+                            </div>
+                            <div className="flex items-center">
+                              <SimilarityVisualizer
+                                similarity={
+                                  getClusterSimilarity(
+                                    selectedClusterIndex,
+                                    comparisonClusterIndex,
+                                  ) ?? 0
+                                }
+                                primary={true}
+                              />
+                            </div>
+                          </>
+                        )}
                       </div>
                     </div>
                   )}
@@ -6,6 +6,7 @@ import { formatTime } from "../utils";
 import IndeterminateLoadingBar from "./IndeterminateLoadingBar";
 import Button from "./Button";
 import AdaptiveClock from "./AdaptiveClock";
+import { TaskProgress } from "../models";
 
 // Potential improvement: Sync this with the python code
 const progression_messages: { [key: string]: string } = {
@@ -36,6 +37,8 @@ export default function ProgressPage({
   const [currentTask, setCurrentTask] = useState<[string, number] | null>(null);
   const [completedTasks, setCompletedTasks] = useState<[string, number][]>([]);
   const [currentTaskTimer, setCurrentTaskTimer] = useState<number>(0);
+  const [currentTaskProgress, setCurrentTaskProgress] =
+    useState<TaskProgress | null>(null);
   const [errorEncountered, setErrorEncountered] = useState(false);
   const navigate = useNavigate();
   const [logsPath, setLogsPath] = useState<string | null>(null);
@@ -88,6 +91,7 @@ export default function ProgressPage({
           }, 500);
         }
         setCurrentTask(progress.currentTask);
+        setCurrentTaskProgress(progress.currentTaskProgress ?? null);
         setCompletedTasks(progress.completedTasks);
       });
     }, 1000);
@@ -209,6 +213,21 @@ export default function ProgressPage({
                   <p className="min-w-28">{formatTime(currentTaskTimer)}</p>
                 </div>
               </div>
+              {currentTaskProgress &&
+                currentTaskProgress.step === currentTask[0] && (
+                  <div className="flex items-center justify-between pl-10 text-base opacity-75">
+                    <p>
+                      {currentTaskProgress.done} / {currentTaskProgress.total}{" "}
+                      ({currentTaskProgress.rate.toFixed(1)} per second)
+                    </p>
+                    {currentTaskProgress.eta !== null && (
+                      <p>
+                        about{" "}
+                        {formatTime(Math.round(currentTaskProgress.eta))} left
+                      </p>
+                    )}
+                  </div>
+                )}
             </div>
           )}
           <div className="flex flex-col justify-start gap-2">
@@ -226,7 +226,15 @@ export default function ResultsPage({
           setIsOpen={setClusterAssignmentsModalOpen}
         />
         <ClusterSimilarityModal
-          similaritiesPath={`${resultsDir}/pairwise_similarities.json`}
+          similaritiesPath={
+            args.algorithmSettings.advancedOptions.similaritiesFormat ===
+            "top_n"
+              ? `${resultsDir}/pairwise_similarities_top_n.json`
+              : `${resultsDir}/pairwise_similarities.json`
+          }
+          similaritiesFormat={
+            args.algorithmSettings.advancedOptions.similaritiesFormat ?? "full"
+          }
           clusterAssignmentsPath={`${resultsDir}/cluster_assignments.csv`}
           delimiter={args.fileSettings.delimiter}
           isOpen={clusterSimilarityModalOpen}
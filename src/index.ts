@@ -4,10 +4,16 @@ import log from "electron-log/main";
 import squirrel from "electron-squirrel-startup";
 import fs from "fs";
 import path from "path";
+import readline from "readline";
 import {
+  Args,
   FileSettings,
   AlgorithmSettings,
+  JobMessage,
   ProgressMessage,
+  TaskProgressMessage,
+  WarningMessage,
+  StageMetricsMessage,
   RunStatus,
   Settings,
 } from "./models";
@@ -47,7 +53,8 @@ console.log(`Root directory: ${rootDir}`);
 console.log(`Data directory: ${dataDir}`);
 console.log(`Output directory: ${outputDir}`);
 
-let script: ChildProcess | undefined;
+let worker: ChildProcess | undefined;
+let currentJobId: string | undefined;
 let mainWindow: BrowserWindow;
 
 let currentRun: RunStatus = {
@@ -77,12 +84,125 @@ if (squirrel) {
   app.quit();
 }
 
-const startScript = async (
-  fileSettings: FileSettings,
-  algorithmSettings: AlgorithmSettings,
-) => {
-  const advancedOptions = algorithmSettings.advancedOptions;
-  // let pythonPath: string;
+const handleWorkerMessage = (message: string) => {
+  const prog = currentRun.progress;
+  try {
+    const parsedMessage = JSON.parse(message);
+    // a previous job may still be draining in the worker after a new run
+    // started, its progress must not end up in the new run
+    if (
+      ["progress", "task_progress", "run_name"].includes(parsedMessage.type) &&
+      parsedMessage.jobId !== currentJobId
+    ) {
+      console.log(
+        `Ignoring ${parsedMessage.type} of stale job: ${parsedMessage.jobId}`,
+      );
+      return;
+    }
+    if (parsedMessage.type === "progress") {
+      const progress = parsedMessage as ProgressMessage;
+      if (progress.status === "TODO") {
+        prog.pendingTasks.push(progress.step);
+      }
+      if (progress.status === "STARTED") {
+        prog.currentTask = [progress.step, Date.parse(progress.timestamp)];
+        prog.pendingTasks.map((message, index) => {
+          if (message === progress.step) {
+            prog.pendingTasks.splice(index, 1);
+          }
+        });
+      }
+      if (progress.status === "DONE") {
+        prog.pendingTasks.map((message, index) => {
+          if (message === progress.step) {
+            prog.pendingTasks.splice(index, 1);
+          }
+        });
+        if (prog.currentTask && prog.currentTask[0] === progress.step) {
+          prog.currentTask = null;
+        }
+        if (prog.currentTaskProgress?.step === progress.step) {
+          prog.currentTaskProgress = null;
+        }
+        prog.completedTasks.push([
+          progress.step,
+          Date.parse(progress.timestamp),
+        ]);
+        console.log(
+          `Completed task: ${progress.step} at ${progress.timestamp}`,
+        );
+      }
+    }
+    if (parsedMessage.type === "task_progress") {
+      const taskProgress = parsedMessage as TaskProgressMessage;
+      prog.currentTaskProgress = {
+        step: taskProgress.step,
+        done: taskProgress.done,
+        total: taskProgress.total,
+        rate: taskProgress.rate,
+        eta: taskProgress.eta,
+      };
+    }
+    if (parsedMessage.type === "warning") {
+      const warning = parsedMessage as WarningMessage;
+      console.warn(`Python ${warning.level}: ${warning.message}`);
+    }
+    if (parsedMessage.type === "stage_metrics") {
+      const stage = parsedMessage as StageMetricsMessage;
+      console.log(
+        `Stage ${stage.name}: ${stage.wallTime.toFixed(3)}s wall, ` +
+          `${stage.cpuTime.toFixed(3)}s CPU, ` +
+          `peak ${stage.peakRssMb?.toFixed(0) ?? "?"} MB` +
+          (stage.neighborSearch !== null
+            ? `, ${stage.neighborSearch} neighbor search`
+            : "") +
+          (stage.neighborRecall !== null
+            ? `, ivf recall ${stage.neighborRecall.toFixed(3)}`
+            : "") +
+          (stage.cached ? " (cached)" : ""),
+      );
+    }
+    if (parsedMessage.type === "run_name") {
+      currentRun.name = parsedMessage.name;
+    }
+    if (parsedMessage.type === "job") {
+      const job = parsedMessage as JobMessage;
+      // a job line the worker could not parse is reported without a job id,
+      // only the current job can have sent it
+      if (job.jobId === null && job.status === "ERROR") {
+        job.jobId = currentJobId ?? null;
+      }
+      if (job.jobId !== currentJobId) {
+        console.log(`Ignoring message for stale job: ${job.jobId}`);
+        return;
+      }
+      if (job.status === "DONE") {
+        mainWindow.setProgressBar(-1);
+        console.log(`Job ${job.jobId} completed: ${job.resultDir}`);
+        currentRun.status = "COMPLETED";
+      }
+      if (job.status === "ERROR") {
+        mainWindow.setProgressBar(-1);
+        console.error(`Job ${job.jobId} failed`);
+        currentRun.status = "ERROR";
+      }
+    }
+  } catch (error) {
+    console.error(
+      `\n\n\nFailed to parse progress message: ${message} because of ${error}\n\n\n`,
+    );
+    console.log(
+      `\n\n\nFailed to parse progress message: ${message} because of ${error}\n\n\n`,
+    );
+  }
+};
+
+// The clustering worker stays alive between runs, so imports and the
+// loaded language model are reused. Jobs are sent as JSON lines on stdin.
+const getWorker = () => {
+  if (worker && worker.exitCode === null && !worker.killed) {
+    return worker;
+  }
   let executablePath: string;
   const pythonArguments: string[] = [];
   if (!isDev()) {
@@ -111,141 +231,112 @@ const startScript = async (
     pythonArguments.push(scriptPath);
   }
   pythonArguments.push(
-    fileSettings.path,
-    "--delimiter",
-    fileSettings.delimiter,
-    "--language_model",
-    algorithmSettings.advancedOptions.languageModel,
-    "--output_dir",
-    outputDir,
+    "--worker",
+    // the K sweep only needs O(n * K) memory per worker since the cluster
+    // sum silhouette, so the app evaluates one cluster count per core
+    "--k_sweep_workers",
+    "0",
     "--log_dir",
     path.join(dataDir, "logs", "python"),
+    "--embedding_cache_dir",
+    path.join(dataDir, "cache", "embeddings"),
+    "--onnx_cache_dir",
+    path.join(dataDir, "cache", "onnx"),
+    "--stage_cache_dir",
+    path.join(dataDir, "cache", "stages"),
   );
   if (isDev()) {
     pythonArguments.push("--log_level");
     pythonArguments.push("DEBUG");
   }
-  if (fileSettings.hasHeader) {
-    pythonArguments.push("--has_headers");
-  }
-  pythonArguments.push("--selected_columns");
-  fileSettings.selectedColumns.forEach((index) => {
-    pythonArguments.push(index.toString());
-  });
-  if (algorithmSettings.autoClusterCount) {
-    pythonArguments.push("--automatic_k");
-    if (algorithmSettings.maxClusters) {
-      pythonArguments.push("--max_num_clusters");
-      pythonArguments.push(algorithmSettings.maxClusters.toString());
-    }
-  } else {
-    if (algorithmSettings.clusterCount) {
-      pythonArguments.push("--cluster_count");
-      pythonArguments.push(algorithmSettings.clusterCount.toString());
-    } else {
-      console.error("No cluster count specified");
-      return;
-    }
-  }
-  if (algorithmSettings.seed) {
-    pythonArguments.push("--seed");
-    pythonArguments.push(algorithmSettings.seed.toString());
-  } else {
-    const randomSeed = Math.floor(Math.random() * 1000);
-    pythonArguments.push("--seed");
-    pythonArguments.push(randomSeed.toString());
-  }
-  if (algorithmSettings.excludedWords.length > 0) {
-    pythonArguments.push("--excluded_words");
-    pythonArguments.push(algorithmSettings.excludedWords.join(","));
-  }
-  if (advancedOptions.nearestNeighbors && advancedOptions.zScoreThreshold) {
-    pythonArguments.push("--nearest_neighbors");
-    pythonArguments.push(advancedOptions.nearestNeighbors.toString());
-    pythonArguments.push("--z_score_threshold");
-    pythonArguments.push(advancedOptions.zScoreThreshold.toString());
-  }
-  if (advancedOptions.similarityThreshold) {
-    pythonArguments.push("--merge_threshold");
-    pythonArguments.push(advancedOptions.similarityThreshold.toString());
-  }
 
   console.log(
     `Executing Command: ${executablePath} ${pythonArguments.map((arg) => `"${arg}"`).join(" ")}`,
   );
 
-  mainWindow.setProgressBar(1);
-  return new Promise<void>((resolve, reject) => {
-    script = spawn(executablePath, pythonArguments, {
-      cwd: rootDir,
-    });
-    script.on("error", (error) => {
-      console.error(`Error: ${error.message}`);
-      reject(error);
-    });
-    resolve(); // todo: check if this is correct
-    script.stdout?.on("data", (data: Buffer) => {
-      const prog = currentRun.progress;
-      const message = data.toString().trim();
-      try {
-        const parsedMessage = JSON.parse(message);
-        if (parsedMessage.type === "progress") {
-          const progress = parsedMessage as ProgressMessage;
-          if (progress.status === "TODO") {
-            prog.pendingTasks.push(progress.step);
-          }
-          if (progress.status === "STARTED") {
-            prog.currentTask = [progress.step, Date.parse(progress.timestamp)];
-            prog.pendingTasks.map((message, index) => {
-              if (message === progress.step) {
-                prog.pendingTasks.splice(index, 1);
-              }
-            });
-          }
-          if (progress.status === "DONE") {
-            prog.pendingTasks.map((message, index) => {
-              if (message === progress.step) {
-                prog.pendingTasks.splice(index, 1);
-              }
-            });
-            if (prog.currentTask && prog.currentTask[0] === progress.step) {
-              prog.currentTask = null;
-            }
-            prog.completedTasks.push([
-              progress.step,
-              Date.parse(progress.timestamp),
-            ]);
-            console.log(
-              `Completed task: ${progress.step} at ${progress.timestamp}`,
-            );
-          }
-        }
-        if (parsedMessage.type === "run_name") {
-          currentRun.name = parsedMessage.name;
+  const newWorker = spawn(executablePath, pythonArguments, {
+    cwd: rootDir,
+  });
+  newWorker.on("error", (error) => {
+    console.error(`Error: ${error.message}`);
+  });
+  // the worker writes one JSON message per line, readline reassembles
+  // lines that arrive split over several chunks
+  if (newWorker.stdout) {
+    readline
+      .createInterface({ input: newWorker.stdout })
+      .on("line", (line: string) => {
+        if (line.trim()) {
+          handleWorkerMessage(line.trim());
         }
-      } catch (error) {
-        console.error(
-          `\n\n\nFailed to parse progress message: ${message} because of ${error}\n\n\n`,
-        );
-        console.log(
-          `\n\n\nFailed to parse progress message: ${message} because of ${error}\n\n\n`,
-        );
-      }
-    });
-    script.stderr?.on("data", (data: Buffer) => {
-      console.error(`Error: ${data.toString()}`);
-    });
-
-    script.on("close", (code: number) => {
+      });
+  }
+  newWorker.stderr?.on("data", (data: Buffer) => {
+    console.error(`Error: ${data.toString()}`);
+  });
+  newWorker.on("close", (code: number) => {
+    console.log(`Python worker exited with code ${code}`);
+    if (worker === newWorker) {
+      worker = undefined;
+    }
+    if (currentJobId && currentRun.status === "IN_PROGRESS") {
       mainWindow.setProgressBar(-1);
-      console.log(`Python process exited with code ${code}`);
-      if (code === 0) {
-        currentRun.status = "COMPLETED";
-      } else {
-        currentRun.status = "ERROR";
-      }
-    });
+      currentRun.status = "ERROR";
+    }
   });
+  worker = newWorker;
+  return newWorker;
+};
+
+const startScript = async (
+  fileSettings: FileSettings,
+  algorithmSettings: AlgorithmSettings,
+) => {
+  const advancedOptions = algorithmSettings.advancedOptions;
+  if (
+    !algorithmSettings.autoClusterCount &&
+    !algorithmSettings.clusterCount
+  ) {
+    console.error("No cluster count specified");
+    return;
+  }
+  const outlierDetection = Boolean(
+    advancedOptions.nearestNeighbors && advancedOptions.zScoreThreshold,
+  );
+  const job: Args & { jobId: string } = {
+    fileSettings,
+    algorithmSettings: {
+      ...algorithmSettings,
+      maxClusters: algorithmSettings.autoClusterCount
+        ? algorithmSettings.maxClusters || null
+        : null,
+      clusterCount: algorithmSettings.autoClusterCount
+        ? null
+        : algorithmSettings.clusterCount ?? null,
+      seed: algorithmSettings.seed || Math.floor(Math.random() * 1000),
+      excludedWords: algorithmSettings.excludedWords,
+      advancedOptions: {
+        ...advancedOptions,
+        outlierDetection,
+        nearestNeighbors: outlierDetection
+          ? advancedOptions.nearestNeighbors
+          : null,
+        zScoreThreshold: outlierDetection
+          ? advancedOptions.zScoreThreshold
+          : null,
+        similarityThreshold: advancedOptions.similarityThreshold || null,
+      },
+    },
+    outputDir,
+    jobId: Date.now().toString(),
+  };
+
+  console.log(`Submitting job: ${JSON.stringify(job)}`);
+
+  mainWindow.setProgressBar(1);
+  currentJobId = job.jobId;
+  currentRun.status = "IN_PROGRESS";
+  getWorker().stdin?.write(`${JSON.stringify(job)}\n`);
 };
 
 const createMainWindow = () => {
@@ -379,8 +470,10 @@ function handleFirstLaunch() {
       console.error(`Error: ${error.message}`);
       reject(error);
     });
-    launchScript.stdout?.on("data", (data: Buffer) => {
-      const message = data.toString().trim();
+    const handleLaunchMessage = (message: string) => {
+      if (!message) {
+        return;
+      }
       try {
         const parsedMessage = JSON.parse(message) as ProgressMessage;
         if (parsedMessage.status === "STARTED") {
@@ -398,7 +491,12 @@ function handleFirstLaunch() {
           `Failed to parse progress message: ${message} because of ${error}`,
         );
       }
-    });
+    };
+    if (launchScript.stdout) {
+      readline
+        .createInterface({ input: launchScript.stdout })
+        .on("line", (line: string) => handleLaunchMessage(line.trim()));
+    }
     launchScript.stderr?.on("data", (data: Buffer) => {
       console.error(`Error: ${data.toString()}`);
       reject(data.toString());
@@ -453,6 +551,10 @@ app.on("window-all-closed", () => {
   }
 });
 
+app.on("will-quit", () => {
+  worker?.kill();
+});
+
 app.on("activate", () => {
   // On OS X it's common to re-create a window in the app when the
   // dock icon is clicked and there are no other windows open.
@@ -11,6 +11,7 @@ export interface AlgorithmSettings {
   clusterCount: number | null | undefined;
   seed: number | null;
   excludedWords: string[];
+  excludedWordsMode?: "substring" | "whole_word" | "exact";
   advancedOptions: AdvancedOptions;
 }
 
@@ -21,6 +22,16 @@ export interface AdvancedOptions {
   agglomerativeClustering: boolean;
   similarityThreshold: number | null;
   languageModel: string;
+  neighborSearch?: "exact" | "ivf";
+  ivfProbes?: number;
+  minNeighborRecall?: number;
+  silhouetteMetric?: "cosine" | "weighted_cosine" | "euclidean";
+  kSearchStrategy?: "grid" | "coarse_to_fine" | "golden" | "early_stopping";
+  kSearchPatience?: number;
+  similaritiesFormat?: "full" | "top_n";
+  similaritiesTopN?: number;
+  maxSeqLength?: number | null;
+  embeddingBackend?: "torch" | "onnx_int8";
 }
 
 export interface Args {
@@ -33,17 +44,65 @@ export interface ProgressMessage {
   step: string;
   status: "TODO" | "STARTED" | "DONE" | "ERROR";
   timestamp: string;
+  jobId: string | null;
+  type: string;
+}
+
+export interface TaskProgressMessage {
+  step: string;
+  done: number;
+  total: number;
+  rate: number;
+  eta: number | null;
+  timestamp: string;
+  jobId: string | null;
+  type: string;
+}
+
+export interface WarningMessage {
+  level: string;
+  message: string;
+  timestamp: string;
+  type: string;
+}
+
+export interface StageMetricsMessage {
+  name: string;
+  wallTime: number;
+  cpuTime: number;
+  peakRssMb: number | null;
+  items: number | null;
+  cached: boolean;
+  neighborSearch: "exact" | "ivf" | null;
+  neighborRecall: number | null;
+  type: string;
+}
+
+export interface JobMessage {
+  jobId: string | null;
+  status: "STARTED" | "DONE" | "ERROR";
+  resultDir: string | null;
   type: string;
 }
 
 export interface RunNameMessage {
   name: string;
+  jobId: string | null;
   type: string;
 }
 
+export interface TaskProgress {
+  step: string;
+  done: number;
+  total: number;
+  rate: number;
+  eta: number | null;
+}
+
 export interface ClusterProgress {
   pendingTasks: string[];
   currentTask: [string, number] | null;
+  currentTaskProgress?: TaskProgress | null;
   completedTasks: [string, number][];
 }
 
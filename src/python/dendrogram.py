@@ -0,0 +1,60 @@
+import heapq
+
+import numpy as np
+
+
+def build_dendrogram(centers: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Complete-linkage tree of the cosine distances between the cluster
+    centers, as the children of every merge, shape (K - 1, 2), and the
+    distance at which it happens, shape (K - 1,). Node K + i is the cluster
+    formed by the i-th merge, nodes below K are the centers themselves.
+    """
+    from sklearn.cluster import AgglomerativeClustering
+
+    centers = np.asarray(centers)
+    if len(centers) < 2:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.float64)
+    tree = AgglomerativeClustering(
+        n_clusters=1,
+        linkage="complete",
+        metric="cosine",
+        compute_full_tree=True,
+        compute_distances=True,
+    )
+    tree.fit(centers)
+    return tree.children_.astype(np.int64), tree.distances_.astype(np.float64)
+
+
+def cut_dendrogram(
+    children: np.ndarray, distances: np.ndarray, distance_threshold: float
+) -> np.ndarray:
+    """
+    Labels of the centers after merging every pair of clusters closer than
+    distance_threshold. The labels are numbered exactly like those of
+    AgglomerativeClustering(distance_threshold=...) fitted on the same
+    centers, so the cut tree reproduces a fresh merge.
+    """
+    n_leaves = len(children) + 1
+    if n_leaves == 1:
+        return np.zeros(1, dtype=np.int64)
+    n_clusters = int(np.count_nonzero(distances >= distance_threshold)) + 1
+
+    # split the root into n_clusters subtrees, always splitting the most
+    # recently formed cluster first. The heap holds negated node ids
+    nodes = [-(int(children[-1].max()) + 1)]
+    for _ in range(n_clusters - 1):
+        left, right = children[-nodes[0] - n_leaves].tolist()
+        heapq.heappush(nodes, -left)
+        heapq.heappushpop(nodes, -right)
+
+    labels = np.zeros(n_leaves, dtype=np.int64)
+    for label, node in enumerate(nodes):
+        stack = [-node]
+        while stack:
+            node = stack.pop()
+            if node < n_leaves:
+                labels[node] = label
+            else:
+                stack.extend(children[node - n_leaves].tolist())
+    return labels
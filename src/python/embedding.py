@@ -0,0 +1,266 @@
+import atexit
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+from loguru import logger
+
+from metrics import add_child_cpu_time
+from onnx_backend import load_onnx_model
+from progress import ProgressReporter
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+# a batch holds about batch_size * BATCH_REFERENCE_LENGTH tokens, so buckets
+# of short responses get proportionally larger batches and long ones smaller
+BATCH_REFERENCE_LENGTH = 128
+# the shortest bucket covers token lengths up to this, every further bucket
+# doubles it
+MIN_BUCKET_LENGTH = 8
+
+# below this many responses starting the worker processes takes longer than
+# embedding in this process
+MULTI_PROCESS_MIN_RESPONSES = 5000
+# number of responses sent to a worker process at once
+MULTI_PROCESS_CHUNK_SIZE = 1000
+
+
+def token_lengths(
+    model: "SentenceTransformer",
+    responses: list[str],
+    max_seq_length: Optional[int],
+) -> np.ndarray:
+    """Number of tokens of every response after truncation to max_seq_length."""
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None:
+        # no huggingface tokenizer, so approximate with the number of words
+        lengths = np.array([len(response.split()) + 2 for response in responses])
+    else:
+        input_ids = tokenizer(
+            responses,
+            add_special_tokens=True,
+            truncation=max_seq_length is not None,
+            max_length=max_seq_length,
+        )["input_ids"]
+        lengths = np.array([len(ids) for ids in input_ids])
+    if max_seq_length is not None:
+        lengths = np.minimum(lengths, max_seq_length)
+    return lengths.astype(np.int64)
+
+
+def length_buckets(lengths: np.ndarray) -> list[tuple[int, np.ndarray]]:
+    """
+    Groups the responses by padded length into buckets whose bounds double,
+    returning (bucket length, indexes of the responses) for every non-empty
+    bucket. Within a bucket the responses are sorted by length, so a batch
+    is only padded to the length of its longest response.
+    """
+    bucket_lengths = np.maximum(
+        MIN_BUCKET_LENGTH,
+        2 ** np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64),
+    )
+    order = np.argsort(lengths, kind="stable")
+    buckets = []
+    for bucket_length in np.unique(bucket_lengths).tolist():
+        idxs = order[bucket_lengths[order] == bucket_length]
+        buckets.append((bucket_length, idxs))
+    return buckets
+
+
+def encode_responses(
+    model: "SentenceTransformer",
+    responses: list[str],
+    batch_size: int = 32,
+    max_seq_length: Optional[int] = None,
+    progress: Optional[ProgressReporter] = None,
+) -> np.ndarray:
+    """
+    Encodes the responses into normalized embeddings, in their original order.
+
+    The responses are split into length buckets and every bucket is encoded
+    with a batch size scaled to its length, so short survey answers are not
+    padded to the length of paragraphs and are encoded in large batches.
+    Responses longer than max_seq_length tokens (default: the model's own
+    limit) are truncated.
+    """
+    previous_max_seq_length = model.max_seq_length
+    if max_seq_length is not None:
+        model.max_seq_length = max_seq_length
+    try:
+        lengths = token_lengths(model, responses, model.max_seq_length)
+        embeddings: Optional[np.ndarray] = None
+        start_time = time.perf_counter()
+        for bucket_length, idxs in length_buckets(lengths):
+            bucket_batch_size = max(
+                batch_size * BATCH_REFERENCE_LENGTH // bucket_length, 1
+            )
+            logger.debug(
+                f"Encoding {len(idxs)} responses of up to {bucket_length} tokens "
+                f"in batches of {bucket_batch_size}"
+            )
+            for start in range(0, len(idxs), bucket_batch_size):
+                batch_idxs = idxs[start : start + bucket_batch_size]
+                batch_embeddings = model.encode(
+                    [responses[i] for i in batch_idxs.tolist()],
+                    batch_size=len(batch_idxs),
+                    normalize_embeddings=True,
+                    convert_to_numpy=True,
+                )
+                if embeddings is None:
+                    embeddings = np.empty(
+                        (len(responses), batch_embeddings.shape[1]),
+                        dtype=batch_embeddings.dtype,
+                    )
+                embeddings[batch_idxs] = batch_embeddings
+                if progress is not None:
+                    progress.advance(len(batch_idxs))
+        duration = time.perf_counter() - start_time
+    finally:
+        model.max_seq_length = previous_max_seq_length
+    assert embeddings is not None
+
+    n_tokens = int(lengths.sum())
+    logger.info(
+        f"Encoded {len(responses)} responses ({n_tokens} tokens) in "
+        f"{duration:.2f}s: {n_tokens / max(duration, 1e-9):.0f} tokens/s"
+    )
+    return embeddings
+
+
+# model of a worker process of the embedding pool
+worker_model: Optional["SentenceTransformer"] = None
+# the embedding pool is kept between the jobs of a resident worker
+embedding_pool: Optional[ProcessPoolExecutor] = None
+embedding_pool_key: Optional[tuple[str, int, Optional[str]]] = None
+
+
+def init_pool_worker(
+    language_model: str, n_threads: int, onnx_cache_dir: Optional[str]
+):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    global worker_model
+    # the parent process logs the progress of the chunks
+    logger.remove()
+    torch.set_num_threads(n_threads)
+    worker_model = SentenceTransformer(language_model, device="cpu")
+    if onnx_cache_dir is not None:
+        # the parent process has already exported the model
+        worker_model = load_onnx_model(
+            worker_model, language_model, onnx_cache_dir, [], n_threads
+        )
+
+
+def encode_chunk(
+    responses: list[str], batch_size: int, max_seq_length: Optional[int]
+) -> tuple[np.ndarray, float]:
+    # the embeddings and the CPU time of this worker spent on them
+    assert worker_model is not None
+    start_cpu = time.process_time()
+    embeddings = encode_responses(worker_model, responses, batch_size, max_seq_length)
+    return embeddings, time.process_time() - start_cpu
+
+
+def shutdown_embedding_pool():
+    global embedding_pool, embedding_pool_key
+    if embedding_pool is not None:
+        embedding_pool.shutdown(cancel_futures=True)
+    embedding_pool = None
+    embedding_pool_key = None
+
+
+atexit.register(shutdown_embedding_pool)
+
+
+def get_embedding_pool(
+    language_model: str, n_workers: int, onnx_cache_dir: Optional[str]
+) -> ProcessPoolExecutor:
+    global embedding_pool, embedding_pool_key
+    if embedding_pool_key != (language_model, n_workers, onnx_cache_dir):
+        shutdown_embedding_pool()
+        logger.debug(f"Starting {n_workers} embedding processes for {language_model}")
+        n_threads = max((os.cpu_count() or 1) // n_workers, 1)
+        # spawn instead of fork, forked torch thread pools can deadlock
+        embedding_pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_pool_worker,
+            initargs=(language_model, n_threads, onnx_cache_dir),
+        )
+        embedding_pool_key = (language_model, n_workers, onnx_cache_dir)
+    assert embedding_pool is not None
+    return embedding_pool
+
+
+def encode_responses_multi_process(
+    model: "SentenceTransformer",
+    language_model: str,
+    responses: list[str],
+    n_workers: int,
+    batch_size: int = 32,
+    max_seq_length: Optional[int] = None,
+    onnx_cache_dir: Optional[str] = None,
+    progress: Optional[ProgressReporter] = None,
+) -> np.ndarray:
+    """
+    Encodes the responses like encode_responses(), but shards them across a
+    pool of CPU worker processes that each hold their own copy of the model.
+
+    The responses are sorted by length and cut into chunks of
+    MULTI_PROCESS_CHUNK_SIZE, so every chunk is padded little, and the chunks
+    are collected in order as they finish. With onnx_cache_dir set the
+    workers run the quantized ONNX model exported there. Small inputs, a
+    single worker and models on a GPU are encoded in this process instead.
+    """
+    if (
+        n_workers <= 1
+        or len(responses) < MULTI_PROCESS_MIN_RESPONSES
+        or model.device.type != "cpu"
+    ):
+        return encode_responses(model, responses, batch_size, max_seq_length, progress)
+
+    lengths = token_lengths(model, responses, max_seq_length or model.max_seq_length)
+    order = np.argsort(lengths, kind="stable")
+    chunks = [
+        order[start : start + MULTI_PROCESS_CHUNK_SIZE]
+        for start in range(0, len(order), MULTI_PROCESS_CHUNK_SIZE)
+    ]
+    pool = get_embedding_pool(language_model, n_workers, onnx_cache_dir)
+    start_time = time.perf_counter()
+    results = pool.map(
+        encode_chunk,
+        [[responses[i] for i in chunk.tolist()] for chunk in chunks],
+        [batch_size] * len(chunks),
+        [max_seq_length] * len(chunks),
+    )
+    embeddings: Optional[np.ndarray] = None
+    for chunk_idx, (chunk, (chunk_embeddings, cpu_time)) in enumerate(
+        zip(chunks, results)
+    ):
+        add_child_cpu_time(cpu_time)
+        if embeddings is None:
+            embeddings = np.empty(
+                (len(responses), chunk_embeddings.shape[1]),
+                dtype=chunk_embeddings.dtype,
+            )
+        embeddings[chunk] = chunk_embeddings
+        if progress is not None:
+            progress.advance(len(chunk))
+        logger.info(
+            f"Embedded chunk {chunk_idx + 1}/{len(chunks)} "
+            f"({len(chunk)} responses) in {n_workers} processes"
+        )
+    duration = time.perf_counter() - start_time
+    assert embeddings is not None
+
+    n_tokens = int(lengths.sum())
+    logger.info(
+        f"Encoded {len(responses)} responses ({n_tokens} tokens) in "
+        f"{duration:.2f}s: {n_tokens / max(duration, 1e-9):.0f} tokens/s"
+    )
+    return embeddings
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import time
+import unicodedata
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+
+def response_key(response: str) -> str:
+    # the tokenizers ignore surrounding whitespace and unicode composition,
+    # so responses differing only in those share one embedding
+    normalized = unicodedata.normalize("NFC", response).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent on-disk store of normalized response embeddings for a single
+    language model.
+
+    The embeddings of all cached responses live in one float32 matrix
+    (embeddings.npy) that is memory-mapped on load, while index.json maps the
+    hash of each normalized response to its row and to the time it was last
+    used. When the matrix grows beyond max_bytes the least recently used rows
+    are evicted on save.
+    """
+
+    def __init__(self, cache_dir: str, language_model: str, max_bytes: int):
+        model_key = hashlib.sha256(language_model.encode("utf-8")).hexdigest()[:16]
+        self.dir = os.path.join(cache_dir, model_key)
+        self.language_model = language_model
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(self.dir, "index.json")
+        self.embeddings_file = os.path.join(self.dir, "embeddings.npy")
+
+        # key -> [row, last_used]
+        self.entries: dict[str, list] = {}
+        self.embeddings: Optional[np.ndarray] = None
+        self.new_keys: list[str] = []
+        self.new_embeddings: list[np.ndarray] = []
+        # rows were added, so the matrix has to be rewritten
+        self.dirty = False
+        # only the last used times changed, so rewriting the index suffices
+        self.touched = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_file) or not os.path.exists(
+            self.embeddings_file
+        ):
+            return
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                index = json.load(f)
+            embeddings = np.load(self.embeddings_file, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable embedding cache {self.dir}: {e}")
+            return
+        if (
+            index.get("languageModel") != self.language_model
+            or index.get("rows") != embeddings.shape[0]
+            or embeddings.dtype != np.float32
+        ):
+            logger.warning(f"Discarding inconsistent embedding cache {self.dir}")
+            return
+        self.entries = index["entries"]
+        self.embeddings = embeddings
+        logger.debug(
+            f"Loaded embedding cache {self.dir} with {len(self.entries)} entries"
+        )
+
+    def missing(self, responses: list[str]) -> list[int]:
+        """Indexes of the responses that have no cached embedding."""
+        return [
+            i
+            for i, response in enumerate(responses)
+            if response_key(response) not in self.entries
+        ]
+
+    def lookup(self, responses: list[str]) -> tuple[Optional[np.ndarray], list[int]]:
+        """
+        Returns a float32 matrix with the cached embeddings filled in and the
+        indexes of the responses whose rows still have to be encoded. The
+        matrix is None if the cache is empty.
+        """
+        if self.embeddings is None:
+            return None, list(range(len(responses)))
+        out = np.zeros((len(responses), self.embeddings.shape[1]), dtype=np.float32)
+        hit_idxs: list[int] = []
+        hit_rows: list[int] = []
+        miss_idxs: list[int] = []
+        now = time.time()
+        for i, response in enumerate(responses):
+            entry = self.entries.get(response_key(response))
+            if entry is None:
+                miss_idxs.append(i)
+                continue
+            entry[1] = now
+            hit_idxs.append(i)
+            hit_rows.append(entry[0])
+        if hit_idxs:
+            # a single fancy-indexed read from the memory map
+            out[hit_idxs] = self.embeddings[np.array(hit_rows)]
+            self.touched = True
+        logger.debug(f"Embedding cache hits: {len(hit_idxs)}, misses: {len(miss_idxs)}")
+        return out, miss_idxs
+
+    def add(self, responses: list[str], embeddings: np.ndarray):
+        if len(responses) == 0:
+            return
+        if (
+            self.embeddings is not None
+            and embeddings.shape[1] != self.embeddings.shape[1]
+        ):
+            logger.warning(
+                f"Embedding dimension changed for {self.language_model}, resetting cache"
+            )
+            self.entries = {}
+            self.embeddings = None
+        self.new_keys.extend(response_key(response) for response in responses)
+        self.new_embeddings.append(np.asarray(embeddings, dtype=np.float32))
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            if self.touched:
+                self._save_index(self.entries)
+                self.touched = False
+                logger.debug(f"Updated last used times of embedding cache {self.dir}")
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        now = time.time()
+        new_matrix = (
+            np.concatenate(self.new_embeddings) if self.new_embeddings else None
+        )
+        # (last_used, key, is_new, source row) of every entry we might keep
+        candidates: list[tuple[float, str, bool, int]] = [
+            (entry[1], key, False, entry[0]) for key, entry in self.entries.items()
+        ]
+        new_rows = {key: row for row, key in enumerate(self.new_keys)}
+        candidates.extend((now, key, True, row) for key, row in new_rows.items())
+
+        if self.embeddings is not None:
+            dim = self.embeddings.shape[1]
+        else:
+            assert new_matrix is not None
+            dim = new_matrix.shape[1]
+        max_rows = self.max_bytes // (4 * dim)
+        if len(candidates) > max_rows:
+            # keep the most recently used rows
+            candidates.sort(key=lambda c: c[0], reverse=True)
+            logger.info(
+                f"Evicting {len(candidates) - max_rows} entries from embedding cache"
+            )
+            candidates = candidates[:max_rows]
+        # old rows first, so they can be read from the memory map in one go
+        candidates.sort(key=lambda c: c[2])
+
+        old_rows = [c[3] for c in candidates if not c[2]]
+        new_rows_kept = [c[3] for c in candidates if c[2]]
+        matrix = np.zeros((len(candidates), dim), dtype=np.float32)
+        if old_rows:
+            assert self.embeddings is not None
+            matrix[: len(old_rows)] = self.embeddings[np.array(old_rows)]
+        if new_rows_kept:
+            assert new_matrix is not None
+            matrix[len(old_rows) :] = new_matrix[np.array(new_rows_kept)]
+        entries = {c[1]: [row, c[0]] for row, c in enumerate(candidates)}
+
+        # release the memory map before replacing the file (required on Windows)
+        self.embeddings = None
+        tmp_embeddings_file = self.embeddings_file + ".tmp.npy"
+        np.save(tmp_embeddings_file, matrix)
+        os.replace(tmp_embeddings_file, self.embeddings_file)
+        self._save_index(entries)
+
+        self.entries = entries
+        self.embeddings = np.load(self.embeddings_file, mmap_mode="r")
+        self.new_keys = []
+        self.new_embeddings = []
+        self.dirty = False
+        self.touched = False
+        logger.debug(f"Saved embedding cache {self.dir} with {len(entries)} entries")
+
+    def _save_index(self, entries: dict[str, list]):
+        tmp_index_file = self.index_file + ".tmp"
+        with open(tmp_index_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "languageModel": self.language_model,
+                    "rows": len(entries),
+                    "entries": entries,
+                },
+                f,
+            )
+        os.replace(tmp_index_file, self.index_file)
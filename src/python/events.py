@@ -0,0 +1,29 @@
+import sys
+import threading
+
+from models import CamelModel, WarningMessage
+
+# stdout is the event channel to the Electron app and carries exactly one
+# JSON object per line (NDJSON). JSON never contains a raw newline, so the
+# app can split the stream into messages however it is chunked.
+stdout_lock = threading.Lock()
+
+
+def print_message(message: CamelModel):
+    line = message.model_dump_json(by_alias=True) + "\n"
+    # progress is also reported from worker threads
+    with stdout_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def forward_warning(log_message):
+    """Loguru sink that forwards warnings and errors to the app."""
+    record = log_message.record
+    print_message(
+        WarningMessage(
+            level=record["level"].name,
+            message=record["message"],
+            timestamp=record["time"].isoformat(),
+        )
+    )
@@ -0,0 +1,60 @@
+import re
+from collections import Counter
+from typing import Optional
+
+EXCLUDED_WORDS_MODES = ["substring", "whole_word", "exact"]
+
+
+class ExcludedWordsMatcher:
+    """
+    Case-insensitive matcher for the excluded words, compiled once into a
+    single alternation regex so every response is scanned only once.
+
+    In substring mode a response is excluded if it contains any of the terms,
+    in whole_word mode only if a term appears as a separate word, and in
+    exact mode only if the whole response equals a term.
+    """
+
+    def __init__(self, excluded_words: list[str], mode: str = "substring"):
+        if mode not in EXCLUDED_WORDS_MODES:
+            raise ValueError(f"Unknown excluded words mode: {mode}")
+        self.mode = mode
+        self.terms: list[str] = []
+        seen: set[str] = set()
+        for word in excluded_words:
+            term = word.strip()
+            if term == "" or term.lower() in seen:
+                continue
+            seen.add(term.lower())
+            self.terms.append(term)
+
+        self.counts: Counter[str] = Counter()
+        self.pattern: Optional[re.Pattern] = None
+        if not self.terms:
+            return
+        # one capturing group per term, so a match tells which term it was
+        alternation = "|".join(f"({re.escape(term)})" for term in self.terms)
+        if mode == "whole_word":
+            alternation = rf"(?<!\w)(?:{alternation})(?!\w)"
+        elif mode == "exact":
+            alternation = rf"\s*(?:{alternation})\s*"
+        self.pattern = re.compile(alternation, re.IGNORECASE)
+
+    def match(self, response: str) -> Optional[str]:
+        """Returns the first excluded term found in the response, if any."""
+        if self.pattern is None:
+            return None
+        if self.mode == "exact":
+            m = self.pattern.fullmatch(response)
+        else:
+            m = self.pattern.search(response)
+        if m is None or m.lastindex is None:
+            return None
+        return self.terms[m.lastindex - 1]
+
+    def excludes(self, response: str) -> bool:
+        term = self.match(response)
+        if term is None:
+            return False
+        self.counts[term] += 1
+        return True
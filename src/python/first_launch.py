@@ -2,20 +2,18 @@ import argparse
 import sys
 from huggingface_hub import snapshot_download
 from huggingface_hub.utils import RepositoryNotFoundError, RevisionNotFoundError
+from events import print_message
 from models import ProgressMessage
 from datetime import datetime
-import time
 from loguru import logger
 
 DEFAULT_MODEL = "BAAI/bge-large-en-v1.5"
 
 
 def print_progress_message(step: str, status: str):
-    print(
-        f"{ProgressMessage(step=step, status=status, timestamp=datetime.now().isoformat()).model_dump_json(by_alias=True)} ",
-        flush=True,
+    print_message(
+        ProgressMessage(step=step, status=status, timestamp=datetime.now().isoformat())
     )
-    time.sleep(0.01)
 
 
 def main():
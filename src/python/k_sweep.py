@@ -0,0 +1,370 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from progress import ProgressReporter
+
+SILHOUETTE_METRICS = ["cosine", "weighted_cosine", "euclidean"]
+SILHOUETTE_CHUNK_SIZE = 4096
+
+
+def cosine_silhouette_score(
+    embeddings: np.ndarray,
+    labels: np.ndarray,
+    sample_weights: Optional[np.ndarray] = None,
+) -> float:
+    """
+    Exact mean silhouette coefficient under the cosine distance, without the
+    n x n distance matrix.
+
+    For unit vectors the summed distance from x_i to all points of cluster k
+    is W_k - x_i . S_k, where S_k is the (weighted) sum of the cluster's
+    vectors and W_k its total weight. One n x K matmul against the K sum
+    vectors therefore yields every mean intra- and nearest-cluster distance.
+
+    A sample weight w_i counts response i as w_i identical responses, so the
+    weighted score equals the unweighted score of the expanded data set.
+    Without weights this matches sklearn's silhouette_score(metric="cosine").
+    """
+    from scipy import sparse
+
+    n, d = embeddings.shape
+    _, labels = np.unique(labels, return_inverse=True)
+    K = int(labels.max()) + 1
+    if not 1 < K < n:
+        raise ValueError(
+            f"Number of labels is {K}. Valid values are 2 to n_samples - 1 (inclusive)"
+        )
+    if sample_weights is None:
+        weights = np.ones(n)
+    else:
+        weights = np.asarray(sample_weights, dtype=np.float64)
+
+    # the rows are processed in chunks, so only a chunk of the embeddings is
+    # held in float64 at any time
+    def normalized_chunk(start: int, stop: int) -> np.ndarray:
+        X = np.asarray(embeddings[start:stop], dtype=np.float64)
+        return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+    cluster_sums = np.zeros((K, d))
+    for start in range(0, n, SILHOUETTE_CHUNK_SIZE):
+        stop = min(start + SILHOUETTE_CHUNK_SIZE, n)
+        # (K, chunk) indicator matrix of the weighted cluster memberships
+        indicator = sparse.csr_matrix(
+            (weights[start:stop], (labels[start:stop], np.arange(stop - start))),
+            shape=(K, stop - start),
+        )
+        cluster_sums += indicator @ normalized_chunk(start, stop)
+    cluster_weights = np.bincount(labels, weights=weights, minlength=K)
+
+    s = np.zeros(n)
+    for start in range(0, n, SILHOUETTE_CHUNK_SIZE):
+        stop = min(start + SILHOUETTE_CHUNK_SIZE, n)
+        chunk_labels = labels[start:stop]
+        rows = np.arange(stop - start)
+        # summed distance from every sample to every cluster, shape (chunk, K)
+        summed_distances = (
+            cluster_weights[None, :] - normalized_chunk(start, stop) @ cluster_sums.T
+        )
+
+        # the sample itself is at distance 0, its other copies as well
+        own_weights = cluster_weights[chunk_labels] - 1.0
+        singleton = own_weights <= 0
+        a = summed_distances[rows, chunk_labels] / np.where(singleton, 1.0, own_weights)
+        a = np.maximum(a, 0.0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_distances = summed_distances / cluster_weights[None, :]
+        mean_distances[rows, chunk_labels] = np.inf
+        b = np.min(mean_distances, axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s_chunk = (b - a) / np.maximum(a, b)
+        # silhouette of samples in single-response clusters is 0 by definition
+        s_chunk[singleton] = 0.0
+        s[start:stop] = np.nan_to_num(s_chunk)
+    return float(np.average(s, weights=weights))
+
+
+def evaluate_cluster_count(
+    embeddings_normalized: np.ndarray,
+    K: int,
+    sample_weights: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+    silhouette_metric: str = "cosine",
+) -> tuple[float, float]:
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+
+    logger.info(f"Computing K = {K}")
+    clustering = KMeans(n_clusters=K, n_init="auto", random_state=seed)
+    clustering.fit(embeddings_normalized, sample_weight=sample_weights)
+    if silhouette_metric == "cosine":
+        sil = cosine_silhouette_score(embeddings_normalized, clustering.labels_)
+    elif silhouette_metric == "weighted_cosine":
+        sil = cosine_silhouette_score(
+            embeddings_normalized, clustering.labels_, sample_weights
+        )
+    else:
+        # exact euclidean silhouette, builds the pairwise distance matrix
+        sil = silhouette_score(np.asarray(embeddings_normalized), clustering.labels_)
+    # compute the BIC score, which is a combination of the distance of each
+    # response to its cluster center - provided by the clustering itself -
+    bic = -clustering.score(embeddings_normalized)
+    # ... and the number of parameters in our model, estimated by K
+    bic += K
+    return float(sil), float(bic)
+
+
+def resolve_worker_count(n_workers: int) -> int:
+    # 0 (or less) means one worker per CPU core
+    if n_workers <= 0:
+        return os.cpu_count() or 1
+    return n_workers
+
+
+def sweep_cluster_counts(
+    embeddings_normalized: np.ndarray,
+    K_values: list[int],
+    sample_weights: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+    n_workers: int = 1,
+    silhouette_metric: str = "cosine",
+    progress: Optional[ProgressReporter] = None,
+) -> tuple[list[float], list[float]]:
+    """
+    Fits KMeans for every K in K_values and returns the silhouette and BIC
+    scores in the order of K_values.
+
+    With more than one worker the Ks are spread over a thread pool. KMeans and
+    the numpy kernels behind both scores release the GIL, so the threads run
+    in parallel while all of them read the same embedding matrix instead of
+    a copy per worker. Every fit is seeded exactly like in the serial sweep,
+    so the scores do not depend on the number of workers.
+    """
+    n_workers = min(resolve_worker_count(n_workers), len(K_values))
+
+    def evaluate(K: int) -> tuple[float, float]:
+        result = evaluate_cluster_count(
+            embeddings_normalized, K, sample_weights, seed, silhouette_metric
+        )
+        if progress is not None:
+            progress.advance()
+        return result
+
+    if n_workers <= 1:
+        results = [evaluate(K) for K in K_values]
+    else:
+        logger.debug(f"Sweeping {len(K_values)} values of K with {n_workers} workers")
+        # split the cores between the workers instead of letting every
+        # KMeans fit start a full set of OpenMP and BLAS threads
+        from threadpoolctl import threadpool_limits
+
+        threads_per_worker = max((os.cpu_count() or 1) // n_workers, 1)
+        with threadpool_limits(limits=threads_per_worker), ThreadPoolExecutor(
+            max_workers=n_workers
+        ) as executor:
+            # the largest Ks take the longest, so they are started first
+            futures = {
+                K: executor.submit(evaluate, K) for K in sorted(K_values, reverse=True)
+            }
+            results = [futures[K].result() for K in K_values]
+
+    sils = [sil for sil, _ in results]
+    bics = [bic for _, bic in results]
+    return sils, bics
+
+
+SEARCH_STRATEGIES = ["grid", "coarse_to_fine", "golden", "early_stopping"]
+# number of Ks in the coarse grid that the adaptive strategies start from
+COARSE_GRID_SIZE = 8
+
+
+def grid_cluster_counts(max_num_clusters: int) -> list[int]:
+    if max_num_clusters < 50:
+        # for max_num_clusters < 50, we try every possible value
+        return list(range(2, max_num_clusters + 1))
+    elif max_num_clusters < 100:
+        # for max_num_clusters >= 50, we try every fifth value
+        return list(range(2, 51)) + list(range(55, max_num_clusters + 1, 5))
+    else:
+        # for max_num_clusters >= 100, we try every tenth value
+        return (
+            list(range(2, 51))
+            + list(range(55, 101, 5))
+            + list(range(110, max_num_clusters + 1, 10))
+        )
+
+
+def normalize_scores(
+    sils: list[float], bics: list[float]
+) -> tuple[np.ndarray, np.ndarray]:
+    # post-process both scales between 0 and 1 to be easier to
+    # read visually
+    sils_array = np.array(sils)
+    sils_array = (sils_array - np.min(sils_array)) / (
+        np.max(sils_array) - np.min(sils_array)
+    )
+
+    bics_array = -np.array(bics)
+    bics_array = (bics_array - np.min(bics_array)) / (
+        np.max(bics_array) - np.min(bics_array)
+    )
+    return sils_array, bics_array
+
+
+class ClusterCountSearch:
+    """
+    Searches the number of clusters that maximizes the product of the
+    normalized silhouette and inverse BIC scores.
+
+    Every evaluated K is remembered, so a strategy can ask for the same K
+    twice at no cost. The normalization is always taken over all Ks evaluated
+    so far, exactly as for the full grid.
+    """
+
+    def __init__(
+        self,
+        embeddings_normalized: np.ndarray,
+        max_num_clusters: int,
+        sample_weights: Optional[np.ndarray] = None,
+        seed: Optional[int] = None,
+        n_workers: int = 1,
+        silhouette_metric: str = "cosine",
+        progress: Optional[ProgressReporter] = None,
+    ):
+        self.embeddings_normalized = embeddings_normalized
+        self.max_num_clusters = max_num_clusters
+        self.sample_weights = sample_weights
+        self.seed = seed
+        self.n_workers = n_workers
+        self.silhouette_metric = silhouette_metric
+        # the adaptive strategies only know the Ks of the next round, so
+        # the total grows with every call of evaluate()
+        self.progress = progress
+        # K -> (silhouette, BIC), in the order of evaluation
+        self.scores: dict[int, tuple[float, float]] = {}
+
+    def evaluate(self, K_values: list[int]):
+        new_K_values = sorted(
+            {K for K in K_values if 2 <= K <= self.max_num_clusters} - set(self.scores)
+        )
+        if not new_K_values:
+            return
+        if self.progress is not None:
+            self.progress.add_total(len(new_K_values))
+        sils, bics = sweep_cluster_counts(
+            self.embeddings_normalized,
+            new_K_values,
+            self.sample_weights,
+            self.seed,
+            self.n_workers,
+            self.silhouette_metric,
+            self.progress,
+        )
+        for K, sil, bic in zip(new_K_values, sils, bics):
+            self.scores[K] = (sil, bic)
+
+    def evaluated_scores(self) -> tuple[list[int], np.ndarray, np.ndarray]:
+        """The evaluated Ks in ascending order with their normalized scores."""
+        K_values = sorted(self.scores)
+        sils, bics = normalize_scores(
+            [self.scores[K][0] for K in K_values],
+            [self.scores[K][1] for K in K_values],
+        )
+        return K_values, sils, bics
+
+    def best(self) -> int:
+        # identify the number of clusters automatically by selecting
+        # the K that achieves the best product of both silhouette score
+        # and BIC. The product is chosen to achieve both high silhoutte
+        # AND high BIC score.
+        K_values, sils, bics = self.evaluated_scores()
+        return K_values[np.argmax(sils * bics)]
+
+    def objective(self, K: int) -> float:
+        K_values, sils, bics = self.evaluated_scores()
+        i = K_values.index(K)
+        return float(np.nan_to_num(sils[i] * bics[i]))
+
+    def search(self, strategy: str, patience: int = 5) -> int:
+        if strategy == "grid":
+            self.evaluate(grid_cluster_counts(self.max_num_clusters))
+        elif strategy == "coarse_to_fine":
+            self.coarse_to_fine()
+        elif strategy == "golden":
+            self.golden_section()
+        elif strategy == "early_stopping":
+            self.early_stopping(patience)
+        else:
+            raise ValueError(f"Unknown search strategy: {strategy}")
+        logger.info(
+            f"Evaluated {len(self.scores)} values of K with the {strategy} search"
+        )
+        return self.best()
+
+    def coarse_grid(self) -> tuple[list[int], int]:
+        # both ends are always evaluated, so the normalization of the scores
+        # spans the whole range from the start
+        step = max((self.max_num_clusters - 2) // (COARSE_GRID_SIZE - 1), 1)
+        K_values = list(range(2, self.max_num_clusters + 1, step))
+        K_values.append(self.max_num_clusters)
+        return K_values, step
+
+    def coarse_to_fine(self):
+        """
+        Evaluates a coarse grid, then repeatedly halves the step size
+        around the best K found so far.
+        """
+        K_values, step = self.coarse_grid()
+        self.evaluate(K_values)
+        while step > 1:
+            step = (step + 1) // 2
+            best = self.best()
+            self.evaluate([best - step, best + step])
+
+    def golden_section(self):
+        """
+        Brackets the best K of the coarse grid by its neighbors and narrows
+        the bracket with a golden-section search, assuming the score is
+        unimodal within it.
+        """
+        K_values, step = self.coarse_grid()
+        self.evaluate(K_values)
+        best = self.best()
+        low = max(best - step, 2)
+        high = min(best + step, self.max_num_clusters)
+        inverse_phi = (np.sqrt(5) - 1) / 2
+        while high - low > 3:
+            c = high - int(round((high - low) * inverse_phi))
+            d = low + int(round((high - low) * inverse_phi))
+            if c == d:
+                d = c + 1
+            self.evaluate([c, d])
+            if self.objective(c) >= self.objective(d):
+                high = d
+            else:
+                low = c
+        self.evaluate(list(range(low, high + 1)))
+
+    def early_stopping(self, patience: int):
+        """
+        Walks through the grid in ascending order and stops once `patience`
+        Ks past the best one have been evaluated without finding a better one.
+        """
+        K_values = grid_cluster_counts(self.max_num_clusters)
+        self.evaluate([K_values[0], K_values[-1]])
+        # one batch per round keeps all workers busy
+        batch_size = resolve_worker_count(self.n_workers)
+        walked: list[int] = []
+        for start in range(0, len(K_values), batch_size):
+            batch = K_values[start : start + batch_size]
+            self.evaluate(batch)
+            walked.extend(batch)
+            best = self.best()
+            if sum(1 for K in walked if K > best) >= patience:
+                logger.info(f"Stopping the search early after K = {batch[-1]}")
+                break
@@ -1,34 +1,75 @@
-from collections import Counter
+from collections import Counter, OrderedDict
 from datetime import datetime
 import json
+import multiprocessing
 import os
 import csv
 import sys
-from typing import Optional
-from matplotlib import pyplot as plt
+from typing import TYPE_CHECKING, Optional
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import AgglomerativeClustering, KMeans
-from sklearn.metrics import silhouette_score
 from loguru import logger
+from pydantic import ValidationError
 import argparse
 import time
 
+from dendrogram import build_dendrogram, cut_dendrogram
+from embedding import encode_responses_multi_process
+from embedding_cache import EmbeddingCache
+from events import forward_warning, print_message
+from excluded_words import EXCLUDED_WORDS_MODES, ExcludedWordsMatcher
+from metrics import MetricsRecorder
+from profiling import StageProfiler
+from neighbors import (
+    IVF_PROBES,
+    MIN_NEIGHBOR_RECALL,
+    NEIGHBOR_SEARCHES,
+    neighbor_similarities,
+)
+from onnx_backend import EMBEDDING_BACKENDS, load_onnx_model
+from online_kmeans import CHECKPOINT_FILE, OnlineClusteringState
+from progress import ProgressReporter
+from results_bundle import (
+    decode_strings,
+    encode_strings,
+    load_results_bundle,
+    save_results_bundle,
+    update_results_bundle,
+)
+from stage_cache import StageCache, file_digest, stage_key
+from k_sweep import (
+    SEARCH_STRATEGIES,
+    SILHOUETTE_METRICS,
+    ClusterCountSearch,
+    resolve_worker_count,
+)
 from models import (
     Args,
+    ClusteringJob,
     Cluster,
     Response,
     Merger,
     Mergers,
+    SimilarityPair,
     TimeStamp,
     TimeStamps,
+    StageMetrics,
+    StageMetricsMessage,
+    Metrics,
     FileSettings,
     AlgorithmSettings,
     AdvancedOptions,
+    RuntimeOptions,
     ProgressMessage,
+    TaskProgressMessage,
     RunNameMessage,
+    JobMessage,
 )
 
+# torch, sentence-transformers, sklearn, scipy and matplotlib take seconds to
+# import, so they are only imported by the stages that need them
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
 progression_messages = {
     "process_input_file": "Reading input file",
     "download_model": "Downloading language model",
@@ -42,16 +83,33 @@ progression_messages = {
 }
 
 time_stamps: list[TimeStamp] = []
+# the job a worker is running, sent with every message about its progress
+current_job_id: Optional[str] = None
+
+
+def print_stage_metrics_message(stage_metrics: StageMetrics):
+    print_message(StageMetricsMessage(**stage_metrics.model_dump()))
+
+
+metrics = MetricsRecorder(print_stage_metrics_message)
+
+# language models kept in memory between the jobs of a worker,
+# least recently used first
+loaded_models: OrderedDict[str, "SentenceTransformer"] = OrderedDict()
 
 
 def process_input_file(
     file_settings: FileSettings,
     excluded_words: list[str],
+    excluded_words_mode: str = "substring",
 ):
     logger.info(f"STARTED: {progression_messages['process_input_file']}")
     print_progress_message("process_input_file", "STARTED")
-    rows: list[list[str]] = []
+    # only the responses are kept in memory, save_amended_file() streams
+    # through the file a second time to write the output
+    row_count = 0
     response_counts: Counter[str] = Counter()
+    matcher = ExcludedWordsMatcher(excluded_words, excluded_words_mode)
     with open(file_settings.path, encoding="utf-8") as f:
         reader = csv.reader(f, delimiter=file_settings.delimiter)
         if file_settings.has_header:
@@ -66,22 +124,16 @@ def process_input_file(
         logger.debug(f"Column indexes: {col_idxs}")
 
         for row in reader:
-            rows.append(row)
+            row_count += 1
 
             for column_index in col_idxs:
                 # get the next entry provided by the current participant
                 response = row[column_index]
                 if response == "" or response is None:
                     continue
-                for excluded_word in excluded_words:
-                    if (
-                        excluded_word != ""
-                        and excluded_word.lower() in response.lower()
-                    ):
-                        logger.info(
-                            f"Excluded word found: {excluded_word} in response: {response}"
-                        )
-                        break
+                if matcher.excludes(response):
+                    logger.debug(f"Excluded word found in response: {response}")
+                    continue
                 # otherwise, count the response
                 response_counts[response] += 1
     unique_response_count = len(response_counts)
@@ -93,16 +145,31 @@ def process_input_file(
             name=progression_messages["process_input_file"], time=int(time.time())
         )
     )
-    logger.debug(f"Number of rows: {len(rows)}")
+    logger.debug(f"Number of rows: {row_count}")
     logger.debug(f"Number of unique responses: {unique_response_count}")
+    excluded_counts = {term: matcher.counts[term] for term in matcher.terms}
+    logger.info(f"Excluded responses per term: {excluded_counts}")
+
+    return responses, response_counts, excluded_counts
 
-    return responses, response_counts, [headers] + rows
 
+def load_model(
+    language_model: str, max_loaded_models: int = 1
+) -> "SentenceTransformer":
+    from sentence_transformers import SentenceTransformer
 
-def load_model(language_model: str) -> SentenceTransformer:
     logger.info(f"STARTED: {progression_messages['load_model']}")
     print_progress_message("load_model", "STARTED")
-    model = SentenceTransformer(language_model)
+    if language_model in loaded_models:
+        logger.debug(f"Reusing loaded model: {language_model}")
+        loaded_models.move_to_end(language_model)
+        model = loaded_models[language_model]
+    else:
+        model = SentenceTransformer(language_model)
+        loaded_models[language_model] = model
+        while len(loaded_models) > max(max_loaded_models, 1):
+            evicted_model, _ = loaded_models.popitem(last=False)
+            logger.debug(f"Unloaded model: {evicted_model}")
     logger.info(f"COMPLETED: {progression_messages['load_model']}")
     print_progress_message("load_model", "DONE")
     time_stamps.append(
@@ -111,13 +178,133 @@ def load_model(language_model: str) -> SentenceTransformer:
     return model
 
 
-def embed_responses(responses: list[str], model: SentenceTransformer) -> np.ndarray:
+def skip_load_model():
+    # every embedding is cached, so the model is not needed for this run
+    logger.info(f"SKIPPED: {progression_messages['load_model']}")
+    print_progress_message("load_model", "DONE")
+    time_stamps.append(
+        TimeStamp(name=progression_messages["load_model"], time=int(time.time()))
+    )
+
+
+def open_embedding_cache(
+    advanced_options: AdvancedOptions, runtime_options: RuntimeOptions
+) -> Optional[EmbeddingCache]:
+    if runtime_options.embedding_cache_dir is None:
+        return None
+    # truncated embeddings are cached separately from the full ones
+    cache_model_key = advanced_options.language_model
+    if advanced_options.max_seq_length is not None:
+        cache_model_key += f"@{advanced_options.max_seq_length}"
+    if advanced_options.embedding_backend != "torch":
+        cache_model_key += f"@{advanced_options.embedding_backend}"
+    return EmbeddingCache(
+        runtime_options.embedding_cache_dir,
+        cache_model_key,
+        runtime_options.embedding_cache_max_mb * 1024 * 1024,
+    )
+
+
+def load_embedding_model(
+    advanced_options: AdvancedOptions,
+    runtime_options: RuntimeOptions,
+    responses: list[str],
+):
+    model = load_model(
+        advanced_options.language_model, runtime_options.max_loaded_models
+    )
+    if advanced_options.embedding_backend == "onnx_int8":
+        model = load_onnx_model(
+            model,
+            advanced_options.language_model,
+            runtime_options.onnx_cache_dir,
+            responses,
+        )
+    return model
+
+
+def embed_with_options(
+    responses: list[str],
+    model,
+    embedding_cache: Optional[EmbeddingCache],
+    advanced_options: AdvancedOptions,
+    runtime_options: RuntimeOptions,
+) -> np.ndarray:
+    # embed_responses() with the embedding settings of a run
+    return embed_responses(
+        responses,
+        model,
+        embedding_cache,
+        runtime_options.embedding_batch_size,
+        advanced_options.max_seq_length,
+        advanced_options.language_model,
+        runtime_options.embedding_workers,
+        (
+            runtime_options.onnx_cache_dir
+            if advanced_options.embedding_backend == "onnx_int8"
+            else None
+        ),
+    )
+
+
+def load_cached_stage(
+    stage_cache: Optional[StageCache], stage: str, key: str
+) -> Optional[tuple[dict, dict[str, np.ndarray]]]:
+    if stage_cache is None:
+        return None
+    return stage_cache.load(stage, key)
+
+
+def skip_cached_stage(step: str):
+    # the outputs of the step were loaded from the stage cache. time_stamps
+    # are appended by the callers wherever the uncached step appends one
+    logger.info(f"CACHED: {progression_messages[step]}")
+    print_progress_message(step, "DONE")
+
+
+def embed_responses(
+    responses: list[str],
+    model: Optional["SentenceTransformer"],
+    embedding_cache: Optional[EmbeddingCache] = None,
+    batch_size: int = 32,
+    max_seq_length: Optional[int] = None,
+    language_model: str = "",
+    n_workers: int = 1,
+    onnx_cache_dir: Optional[str] = None,
+) -> np.ndarray:
     logger.info(f"STARTED: {progression_messages['embed_responses']}")
     print_progress_message("embed_responses", "STARTED")
-    norm_embeddings = model.encode(
-        responses, normalize_embeddings=True, convert_to_numpy=True
-    )  # shape (no_of_unique_responses, embedding_dim)
-    norm_embeddings = np.array(norm_embeddings)  # Type casting (only for IDE)
+    if embedding_cache is not None:
+        norm_embeddings, miss_idxs = embedding_cache.lookup(responses)
+    else:
+        norm_embeddings, miss_idxs = None, list(range(len(responses)))
+
+    if miss_idxs:
+        assert model is not None
+        # only encode the responses that are not cached yet
+        missing_responses = [responses[i] for i in miss_idxs]
+        progress = ProgressReporter(
+            "embed_responses", len(missing_responses), print_task_progress_message
+        )
+        new_embeddings = encode_responses_multi_process(
+            model,
+            language_model,
+            missing_responses,
+            resolve_worker_count(n_workers),
+            batch_size,
+            max_seq_length,
+            onnx_cache_dir,
+            progress,
+        )  # shape (no_of_missing_responses, embedding_dim)
+        if norm_embeddings is None:
+            norm_embeddings = new_embeddings
+        else:
+            norm_embeddings[miss_idxs] = new_embeddings
+        if embedding_cache is not None:
+            embedding_cache.add(missing_responses, new_embeddings)
+    assert norm_embeddings is not None
+    if embedding_cache is not None:
+        embedding_cache.save()
     logger.info(f"COMPLETED: {progression_messages['embed_responses']}")
     print_progress_message("embed_responses", "DONE")
     time_stamps.append(
@@ -131,33 +318,31 @@ def detect_outliers(
     norm_embeddings: np.ndarray,
     outlier_k: int,
     z_score_threshold: float,
-) -> tuple[list[dict], list[str], np.ndarray]:
+    neighbor_search: str = "exact",
+    seed: Optional[int] = None,
+    ivf_probes: int = IVF_PROBES,
+    min_neighbor_recall: float = MIN_NEIGHBOR_RECALL,
+) -> tuple[list[dict], np.ndarray, str, Optional[float]]:
     logger.info(f"STARTED: {progression_messages['detect_outliers']}")
     print_progress_message("detect_outliers", "STARTED")
-    # compute the overall cosine similarity matrix between all embeddings
-    S = np.dot(norm_embeddings, norm_embeddings.T)
     # get the average cosine similarities to the OUTLIER_K nearest neighbors for
-    # each response (excluding the response itself). The numpy.partition function helps us
-    # with that because it can find the smallest values in an array efficiently.
-    # So we use that to find the OUTLIER_K+1 smallest negative similarities,
-    # take the second to OUTLIER_K+1 values of those (to exclude the similarity
-    # to the response itself), swap the sign again, and take the average.
-
-    # the ordering in the partitions is undefined, indexing the partitioned array directly
-    # is not guaranteed to exclude the similarity to the response itself.
-    # avg_neighbor_sim = np.mean(
-    #     -np.partition(-S, outlier_k + 1, axis=1)[:, 1 : outlier_k + 1], axis=1
-    # )
-
-    # we need to sort the partitioned array to get the correct order
-    partition = np.partition(-S, outlier_k + 1, axis=1)
-    sorted_neighborhood_partition = np.copy(partition)
-    sorted_neighborhood_partition[:, : outlier_k + 1] = np.sort(
-        partition[:, : outlier_k + 1], axis=1
+    # each response (excluding the response itself). The OUTLIER_K+1 largest
+    # similarities of each row are found block by block, without building the
+    # full similarity matrix. The first of those is the similarity of the
+    # response to itself, so we average the second to OUTLIER_K+1 values.
+    progress = ProgressReporter(
+        "detect_outliers", len(norm_embeddings), print_task_progress_message
     )
-    avg_neighbor_sim = np.mean(
-        -sorted_neighborhood_partition[:, 1 : outlier_k + 1], axis=1
+    top_similarities, neighbor_search, neighbor_recall = neighbor_similarities(
+        norm_embeddings,
+        outlier_k + 1,
+        neighbor_search,
+        seed,
+        progress,
+        ivf_probes,
+        min_neighbor_recall,
     )
+    avg_neighbor_sim = np.mean(top_similarities[:, 1 : outlier_k + 1], axis=1)
 
     outlier_threshold = np.mean(avg_neighbor_sim) - z_score_threshold * np.std(
         avg_neighbor_sim
@@ -177,11 +362,8 @@ def detect_outliers(
             }
         )
 
-    # take only the remaining response
+    # the indexes of the remaining responses
     remaining_indexes = np.where(np.logical_not(outlier_bools))[0]
-    responses_remaining: list[str] = []
-    for i in remaining_indexes:
-        responses_remaining.append(responses[i])
 
     logger.info(f"COMPLETED: {progression_messages['detect_outliers']}")
     print_progress_message("detect_outliers", "DONE")
@@ -190,7 +372,7 @@ def detect_outliers(
     )
     logger.debug(f"Number of outliers: {len(outliers)}")
     logger.debug(outlier_stats)
-    return outlier_stats, responses_remaining, norm_embeddings[remaining_indexes, :]
+    return outlier_stats, remaining_indexes, neighbor_search, neighbor_recall
 
 
 def start_clustering(
@@ -199,6 +381,8 @@ def start_clustering(
     sample_weights: np.ndarray,
     seed: Optional[int] = None,
 ):
+    from sklearn.cluster import KMeans
+
     logger.info("STARTED: Clustering")
     print_progress_message("cluster", "STARTED")
     clustering = KMeans(n_clusters=K, n_init="auto", random_state=seed)
@@ -218,35 +402,41 @@ def merge_clusters(
     cluster_centers: np.ndarray,
     embeddings: np.ndarray,
     sample_weights: np.ndarray,
+    dendrogram: Optional[tuple[np.ndarray, np.ndarray]] = None,
 ):
+    from scipy import sparse
+
     logger.info(f"STARTED: {progression_messages['merge']}")
     print_progress_message("merge", "STARTED")
-    # merge the closest clusters using Agglomorative Clustering
-    # until everything is closer than the threshold
-    meta_clustering = AgglomerativeClustering(
-        n_clusters=None,
-        distance_threshold=1.0 - merge_threshold,
-        linkage="complete",
-        metric="cosine",
-    )
-    meta_clustering.fit(np.asarray(cluster_centers))
-
+    # merge the closest clusters using complete-linkage agglomerative
+    # clustering until everything is closer than the threshold, by cutting
+    # the dendrogram of the centers
+    if dendrogram is None:
+        dendrogram = build_dendrogram(cluster_centers)
+    merge_children, merge_distances = dendrogram
+    meta_labels = cut_dendrogram(merge_children, merge_distances, 1.0 - merge_threshold)
+    K_new = len(np.unique(meta_labels))
+
+    # the original clusters of every merged cluster, grouped by one stable sort
+    order = np.argsort(meta_labels, kind="stable")
+    group_bounds = np.concatenate([[0], np.cumsum(np.bincount(meta_labels))])
     mergers: list[Merger] = []
-    for label in np.unique(meta_clustering.labels_):
-        merged = np.where(meta_clustering.labels_ == label)[0]
+    for label in range(K_new):
+        merged = order[group_bounds[label] : group_bounds[label + 1]]
         if len(merged) > 1:
             S = np.dot(cluster_centers[merged, :], cluster_centers[merged, :].T)
-            triu_indices = np.triu_indices(len(S), k=1)
-            similarity_pairs = []
-            for i, j in zip(triu_indices[0].tolist(), triu_indices[1].tolist()):
-                similarity_pairs.append(
-                    {"cluster_pair": [merged[i], merged[j]], "similarity": S[i, j]}
+            rows, cols = np.triu_indices(len(S), k=1)
+            similarity_pairs = [
+                SimilarityPair(cluster_pair=[i, j], similarity=sim)
+                for i, j, sim in zip(
+                    merged[rows].tolist(), merged[cols].tolist(), S[rows, cols].tolist()
                 )
+            ]
             mergers.append(
                 Merger(
                     merged_clusters=[
                         Cluster(index=cluster_idx, responses=[])
-                        for cluster_idx in merged
+                        for cluster_idx in merged.tolist()
                     ],
                     similarity_pairs=similarity_pairs,
                 )
@@ -254,18 +444,17 @@ def merge_clusters(
     logger.debug(mergers)
 
     # override the original k-means result with the merged clusters
-    K_new = len(np.unique(meta_clustering.labels_))
-    for i in range(len(cluster_idxs)):
-        cluster_idxs[i] = meta_clustering.labels_[cluster_idxs[i]]
+    cluster_idxs = meta_labels[cluster_idxs]
 
     # re-set the cluster centers to the weighted mean of all their
-    # points
-    centers_new = np.zeros((K_new, cluster_centers.shape[1]))
-    for k in range(K_new):
-        in_cluster_k = cluster_idxs == k
-        centers_new[k, :] = np.dot(
-            sample_weights[in_cluster_k], embeddings[in_cluster_k, :]
-        ) / np.sum(sample_weights[in_cluster_k])
+    # points, summed with one sparse (K_new, n) indicator matmul
+    indicator = sparse.csr_matrix(
+        (sample_weights, (cluster_idxs, np.arange(len(cluster_idxs)))),
+        shape=(K_new, len(cluster_idxs)),
+    )
+    centers_new = np.asarray(indicator @ embeddings) / np.bincount(
+        cluster_idxs, weights=sample_weights, minlength=K_new
+    ).reshape(-1, 1)
 
     # normalize the cluster centers again to unit length
     cluster_centers = centers_new / np.linalg.norm(
@@ -279,6 +468,41 @@ def merge_clusters(
     return cluster_idxs, cluster_centers, mergers
 
 
+def rank_by_similarity_to_center(
+    cluster_idxs: np.ndarray,
+    embeddings_normalized: np.ndarray,
+    centers_normalized: np.ndarray,
+    K: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Orders all responses by cluster, and within each cluster descendingly by
+    the cosine similarity of their embedding to the cluster center. Returns
+    the order and the similarity of every response to its own center.
+
+    The responses are grouped with a single stable sort, and each group is
+    multiplied with its center in one matrix-vector product and sorted on
+    its own. A row-wise dot over all responses at once would round
+    differently, and a global lexsort would order identical similarities
+    (e.g. responses that differ only in case) differently than before.
+    """
+    sim = np.empty(
+        len(cluster_idxs),
+        dtype=np.result_type(embeddings_normalized, centers_normalized),
+    )
+    groups = np.argsort(cluster_idxs, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(cluster_idxs, minlength=K))])
+    order = np.empty_like(groups)
+    for k in range(K):
+        # the indices of all responses in cluster k
+        in_cluster_k = groups[bounds[k] : bounds[k + 1]]
+        if len(in_cluster_k) == 0:
+            continue
+        sim_k = np.dot(embeddings_normalized[in_cluster_k, :], centers_normalized[k, :])
+        sim[in_cluster_k] = sim_k
+        order[bounds[k] : bounds[k + 1]] = in_cluster_k[np.argsort(-sim_k)]
+    return order, sim
+
+
 def save_cluster_assignments(
     results_dir: str,
     K: int,
@@ -295,39 +519,41 @@ def save_cluster_assignments(
         # similarity to center refers to the distance from embedding to the
         # cluster mean which is a measure of how representative
         # the response is for the cluster
+        # iterate over all responses by cluster - but sort descendingly
+        # by the cosine similarity because we may want to label clusters by
+        # the most similar responses
+        order, sim = rank_by_similarity_to_center(
+            cluster_idxs, embeddings_normalized, centers_normalized, K
+        )
+        writer.writerows(
+            zip(
+                [responses[i] for i in order.tolist()],
+                cluster_idxs[order].tolist(),
+                sim[order].tolist(),
+            )
+        )
 
-        for k in range(K):
-            # get the indices of all responses in cluster k
-            in_cluster_k = np.where(cluster_idxs == k)[0]
 
-            if len(in_cluster_k) == 0:
-                continue
-
-            # compute the cosine similarity of the embeddings of all responses
-            # in cluster k to the mean of cluster k
-            sim = np.dot(
-                embeddings_normalized[in_cluster_k, :], centers_normalized[k, :]
-            )
-            # iterate over all responses in cluster k - but sort descendingly
-            # by the cosine similarity because we may want to label clusters by
-            # the most similar responses
-            for i in np.argsort(-sim):
-                cluster_col_idx = in_cluster_k[i]
-                response = responses[cluster_col_idx]
-                k = cluster_idxs[cluster_col_idx]
-                s = sim[i].item()
-                writer.writerow([response, k, s])
+SIMILARITIES_FORMATS = ["full", "top_n"]
 
 
 def save_pairwise_similarities(
     results_dir: str,
     centers_normalized: np.ndarray,
     col_delimiter: str = ",",
+    similarities_format: str = "full",
+    top_n: int = 10,
 ):
-    pairwise_similarities_file = f"{results_dir}/pairwise_similarities.json"
     # compute the pairwise similarities between all cluster centers
     S = np.dot(centers_normalized, centers_normalized.T)
 
+    if similarities_format == "top_n":
+        save_top_n_similarities(results_dir, S, top_n)
+        return
+    if similarities_format != "full":
+        raise ValueError(f"Unknown similarities format: {similarities_format}")
+
+    pairwise_similarities_file = f"{results_dir}/pairwise_similarities.json"
     # # get the indexes of the pair of clusters with the highest similarity
     # S_copy = S.copy()
     # # Set diagonal elements to a value less than 1.0 to exclude them from argmax
@@ -342,43 +568,75 @@ def save_pairwise_similarities(
         json.dump(output_dict, f)
 
 
+def save_top_n_similarities(results_dir: str, S: np.ndarray, top_n: int):
+    """
+    Saves only the top_n most similar other clusters of every cluster, sorted
+    descendingly, as clusters[i] = [[j, similarity], ...]. The file grows
+    linearly with the number of clusters instead of quadratically, and the
+    neighbors of a cluster can be read without scanning all pairs.
+    """
+    top_n_similarities_file = f"{results_dir}/pairwise_similarities_top_n.json"
+    K = S.shape[0]
+    # at least one neighbor, jobs from the app are not checked by validate_args
+    n = min(max(top_n, 1), K - 1)
+    S = S.copy()
+    # exclude the similarity of every cluster to itself
+    np.fill_diagonal(S, -np.inf)
+    if n > 0:
+        idxs = np.argpartition(-S, n - 1, axis=1)[:, :n]
+        sims = np.take_along_axis(S, idxs, axis=1)
+        order = np.argsort(-sims, axis=1, kind="stable")
+        idxs = np.take_along_axis(idxs, order, axis=1)
+        sims = np.take_along_axis(sims, order, axis=1)
+        clusters = [
+            [[j, sim] for j, sim in zip(row_idxs, row_sims)]
+            for row_idxs, row_sims in zip(idxs.tolist(), sims.tolist())
+        ]
+    else:
+        clusters = [[] for _ in range(K)]
+    with open(top_n_similarities_file, "w") as f:
+        json.dump({"topN": n, "clusters": clusters}, f)
+
+
 def save_amended_file(
-    input_file_name: str,
+    input_file_path: str,
     results_dir: str,
     responses: list[str],
-    rows: list[list[str]],
     selected_columns: list[int],
     delimiter: str,
     has_headers: bool,
     cluster_idxs: np.ndarray,
 ):
     output_file_path = f"{results_dir}/output.csv"
-    response_index_map = {response: idx for idx, response in enumerate(responses)}
-    for row in rows[1:]:
-        for i in selected_columns:
-            # get the next response provided by the current participant
-            response = row[i]
-            cluster_col_idx = response_index_map.get(response)
-            if cluster_col_idx is None:
-                row.append("")
-                continue
-            k = cluster_idxs[cluster_col_idx]
-            row.append(k)
-
-    with open(output_file_path, "w", encoding="utf-8") as f:
+    # map every response directly to its cluster, as a plain int
+    response_cluster_map = {
+        response: k for response, k in zip(responses, cluster_idxs.tolist())
+    }
+
+    # re-read the input file and write the amended rows one by one, so the
+    # rows never have to be held in memory
+    with open(input_file_path, encoding="utf-8") as input_file, open(
+        output_file_path, "w", encoding="utf-8"
+    ) as f:
+        reader = csv.reader(input_file, delimiter=delimiter)
         writer = csv.writer(f, delimiter=delimiter, lineterminator="\n")
         if has_headers:
+            headers = reader.__next__()
             # add the new columns to the header
-            logger.debug(f"Original Headers: {rows[0]}")
+            logger.debug(f"Original Headers: {headers}")
             logger.debug(f"Selected Columns: {selected_columns}")
-            new_header = rows[0].copy()
+            new_header = headers.copy()
             for i in selected_columns:
-                selected_header = rows[0][i]
+                selected_header = headers[i]
                 new_header.append(f"{selected_header}_cluster_index")
 
             # write the header
             writer.writerow(new_header)
-        writer.writerows(rows[1:])
+        for row in reader:
+            for i in selected_columns:
+                # get the next response provided by the current participant
+                row.append(response_cluster_map.get(row[i], ""))
+            writer.writerow(row)
 
 
 def find_number_of_clusters(
@@ -387,60 +645,24 @@ def find_number_of_clusters(
     results_dir: str,
     sample_weights: Optional[np.ndarray] = None,
     seed: Optional[int] = None,
+    n_workers: int = 1,
+    silhouette_metric: str = "cosine",
+    search_strategy: str = "grid",
+    patience: int = 5,
 ) -> int:
     logger.info(f"STARTED: {progression_messages['find_number_of_clusters']}")
     print_progress_message("find_number_of_clusters", "STARTED")
-    # set up the list of Ks we want to try
-    if max_num_clusters < 50:
-        # for max_num_clusters < 50, we try every possible value
-        K_values = list(range(2, max_num_clusters + 1))
-    elif max_num_clusters < 100:
-        # for max_num_clusters >= 50, we try every fifth value
-        K_values = list(range(2, 51)) + list(range(55, max_num_clusters + 1, 5))
-    else:
-        # for max_num_clusters >= 100, we try every tenth value
-        K_values = (
-            list(range(2, 51))
-            + list(range(55, 101, 5))
-            + list(range(110, max_num_clusters + 1, 10))
-        )
-
-    sils = []
-    bics = []
-    for K in K_values:
-        logger.info(f"Computing K = {K}")
-        clustering = KMeans(n_clusters=K, n_init="auto", random_state=seed)
-        clustering.fit(embeddings_normalized, sample_weight=sample_weights)
-        sil = silhouette_score(np.asarray(embeddings_normalized), clustering.labels_)
-        sils.append(sil)
-        # compute the BIC score, which is a combination of the distance of each
-        # response to its cluster center - provided by the clustering itself -
-        bic = -clustering.score(embeddings_normalized)
-        # ... and the number of parameters in our model, estimated by K
-        bic += K
-        bics.append(bic)
-
-    # post-process both scales between 0 and 1 to be easier to
-    # read visually
-    sils = np.array(sils)
-    sils = (sils - np.min(sils)) / (np.max(sils) - np.min(sils))
-
-    bics = -np.array(bics)
-    bics = (bics - np.min(bics)) / (np.max(bics) - np.min(bics))
-
-    # identify the number of clusters automatically by selecting
-    # the K that achieves the best product of both silhouette score
-    # and BIC. The product is chosen to achieve both high silhoutte
-    # AND high BIC score.
-    K = K_values[np.argmax(sils * bics)]
-
-    plt.plot(K_values, sils)
-    plt.plot(K_values, bics)
-    plt.plot([K, K], [0, 1], "r--")
-    plt.xlabel("number of clusters")
-    plt.ylabel("normalized scores")
-    plt.legend(["silhouette score", "inverse BIC", "automatic suggestion"])
-    plt.savefig(f"{results_dir}/automatic_cluster_count_evaluation.png")
+    search = ClusterCountSearch(
+        embeddings_normalized,
+        max_num_clusters,
+        sample_weights,
+        seed,
+        n_workers,
+        silhouette_metric,
+        ProgressReporter("find_number_of_clusters", 0, print_task_progress_message),
+    )
+    K = search.search(search_strategy, patience)
+    save_cluster_count_search(results_dir, search_strategy, search, K)
 
     logger.info(f"COMPLETED: {progression_messages['find_number_of_clusters']}")
     print_progress_message("find_number_of_clusters", "DONE")
@@ -452,6 +674,51 @@ def find_number_of_clusters(
     return K
 
 
+def save_cluster_count_search(
+    results_dir: str, strategy: str, search: ClusterCountSearch, K: int
+):
+    # records every evaluated K, in the order of evaluation, so adaptive
+    # searches can be compared against the full grid
+    search_file = results_dir + "/cluster_count_search.json"
+    K_values, sils, bics = search.evaluated_scores()
+    normalized = {K: (sil, bic) for K, sil, bic in zip(K_values, sils, bics)}
+    evaluations = [
+        {
+            "k": K_value,
+            "silhouette": sil,
+            "bic": bic,
+            "normalizedSilhouette": float(normalized[K_value][0]),
+            "normalizedInverseBic": float(normalized[K_value][1]),
+        }
+        for K_value, (sil, bic) in search.scores.items()
+    ]
+    with open(search_file, "w") as f:
+        json.dump({"strategy": strategy, "selectedK": K, "evaluations": evaluations}, f)
+
+
+def save_cluster_count_plot(results_dir: str):
+    # renders the scores saved by save_cluster_count_search()
+    from matplotlib.figure import Figure
+
+    with open(results_dir + "/cluster_count_search.json") as f:
+        search = json.load(f)
+    evaluations = sorted(search["evaluations"], key=lambda e: e["k"])
+    K_values = [e["k"] for e in evaluations]
+    K = search["selectedK"]
+
+    # a Figure without pyplot is not registered globally, so nothing leaks
+    # between the jobs of a worker
+    figure = Figure()
+    ax = figure.subplots()
+    ax.plot(K_values, [e["normalizedSilhouette"] for e in evaluations])
+    ax.plot(K_values, [e["normalizedInverseBic"] for e in evaluations])
+    ax.plot([K, K], [0, 1], "r--")
+    ax.set_xlabel("number of clusters")
+    ax.set_ylabel("normalized scores")
+    ax.legend(["silhouette score", "inverse BIC", "automatic suggestion"])
+    figure.savefig(f"{results_dir}/automatic_cluster_count_evaluation.png")
+
+
 def save_outliers(results_dir: str, outlier_stats: list[dict]):
     outlier_stats.sort(key=lambda x: x["similarity"], reverse=True)
     outliers_file = results_dir + "/outliers.json"
@@ -459,6 +726,13 @@ def save_outliers(results_dir: str, outlier_stats: list[dict]):
         json.dump(outlier_stats, f)
 
 
+def save_excluded_words(results_dir: str, excluded_counts: dict[str, int]):
+    # number of excluded responses per excluded word
+    excluded_words_file = results_dir + "/excluded_words.json"
+    with open(excluded_words_file, "w") as f:
+        json.dump(excluded_counts, f)
+
+
 def save_merged_clusters(
     results_dir: str,
     mergers: list[Merger],
@@ -497,6 +771,13 @@ def save_timestamps(results_dir: str):
         f.write(timestamps_model.model_dump_json(by_alias=True))
 
 
+def save_metrics(results_dir: str):
+    metrics_file = results_dir + "/metrics.json"
+    metrics_model = Metrics(stages=metrics.stages)
+    with open(metrics_file, "w") as f:
+        f.write(metrics_model.model_dump_json(by_alias=True))
+
+
 def save_args(
     file_settings: FileSettings,
     algorithm_settings: AlgorithmSettings,
@@ -514,11 +795,36 @@ def save_args(
 
 
 def print_progress_message(step: str, status: str):
-    print(
-        f"{ProgressMessage(step=step, status=status, timestamp=datetime.now().isoformat()).model_dump_json(by_alias=True)} ",
-        flush=True,
+    print_message(
+        ProgressMessage(
+            step=step,
+            status=status,
+            timestamp=datetime.now().isoformat(),
+            job_id=current_job_id,
+        )
+    )
+
+
+def print_task_progress_message(
+    step: str, done: int, total: int, rate: float, eta: Optional[float]
+):
+    print_message(
+        TaskProgressMessage(
+            step=step,
+            done=done,
+            total=total,
+            rate=rate,
+            eta=eta,
+            timestamp=datetime.now().isoformat(),
+            job_id=current_job_id,
+        )
     )
-    time.sleep(0.01)
+
+
+def print_job_message(
+    job_id: Optional[str], status: str, result_dir: Optional[str] = None
+):
+    print_message(JobMessage(job_id=job_id, status=status, result_dir=result_dir))
 
 
 @logger.catch
@@ -526,10 +832,17 @@ def main(
     file_settings: FileSettings,
     algorithm_settings: AlgorithmSettings,
     output_dir: str,
+    runtime_options: RuntimeOptions = RuntimeOptions(),
 ):
     advancedOptions = algorithm_settings.advanced_options
     logger.info("Starting clustering")
+    time_stamps.clear()
     time_stamps.append(TimeStamp(name="start", time=int(time.time())))
+    metrics.clear()
+    if metrics.profiler is not None:
+        # left over from a failed run of a resident worker
+        metrics.profiler.close()
+    metrics.profiler = StageProfiler() if runtime_options.profile else None
 
     logger.info(f"TODO: {progression_messages['process_input_file']}")
     print_progress_message("process_input_file", "TODO")
@@ -562,25 +875,191 @@ def main(
     logger.info(f"TODO: {progression_messages['results']}")
     print_progress_message("results", "TODO")
 
-    responses, response_counts, rows = process_input_file(
-        file_settings=file_settings,
-        excluded_words=algorithm_settings.excluded_words,
+    if runtime_options.stage_cache_dir is not None:
+        stage_cache = StageCache(
+            runtime_options.stage_cache_dir,
+            runtime_options.stage_cache_max_mb * 1024 * 1024,
+        )
+    else:
+        stage_cache = None
+
+    # every stage key hashes the key of the stage it consumes, so a run
+    # resumes from the first stage whose input or settings changed
+    input_key = stage_key(
+        "process_input_file",
+        None,
+        {
+            "file": (
+                file_digest(file_settings.path) if stage_cache is not None else None
+            ),
+            "delimiter": file_settings.delimiter,
+            "hasHeader": file_settings.has_header,
+            "selectedColumns": file_settings.selected_columns,
+            "excludedWords": algorithm_settings.excluded_words,
+            "excludedWordsMode": algorithm_settings.excluded_words_mode,
+        },
+    )
+    with metrics.stage("process_input_file") as stage:
+        cached = load_cached_stage(stage_cache, "process_input_file", input_key)
+        if cached is not None:
+            data, arrays = cached
+            responses = decode_strings(
+                arrays["response_bytes"], arrays["response_offsets"]
+            )
+            response_counts = Counter(dict(zip(responses, arrays["counts"].tolist())))
+            excluded_counts = data["excludedCounts"]
+            skip_cached_stage("process_input_file")
+            time_stamps.append(
+                TimeStamp(
+                    name=progression_messages["process_input_file"],
+                    time=int(time.time()),
+                )
+            )
+            stage.cached = True
+        else:
+            responses, response_counts, excluded_counts = process_input_file(
+                file_settings=file_settings,
+                excluded_words=algorithm_settings.excluded_words,
+                excluded_words_mode=algorithm_settings.excluded_words_mode,
+            )
+            if stage_cache is not None:
+                response_bytes, response_offsets = encode_strings(responses)
+                stage_cache.save(
+                    "process_input_file",
+                    input_key,
+                    {"excludedCounts": excluded_counts},
+                    {
+                        "response_bytes": response_bytes,
+                        "response_offsets": response_offsets,
+                        "counts": np.array(
+                            [response_counts[r] for r in responses], dtype=np.int64
+                        ),
+                    },
+                )
+        stage.items = len(responses)
+
+    embedding_cache = open_embedding_cache(advancedOptions, runtime_options)
+
+    embed_key = stage_key(
+        "embed_responses",
+        input_key,
+        {
+            "languageModel": advancedOptions.language_model,
+            "maxSeqLength": advancedOptions.max_seq_length,
+            "embeddingBackend": advancedOptions.embedding_backend,
+        },
+    )
+    # with an embedding cache the embeddings are rebuilt from it, so the
+    # stage cache does not hold a second copy of them
+    embed_stage_cache = stage_cache if embedding_cache is None else None
+    cached_embeddings = load_cached_stage(
+        embed_stage_cache, "embed_responses", embed_key
     )
 
-    model = load_model(advancedOptions.language_model)
-
-    embeddings = embed_responses(responses, model)
-
+    with metrics.stage("load_model"):
+        if cached_embeddings is None and (
+            embedding_cache is None or embedding_cache.missing(responses)
+        ):
+            model = load_embedding_model(advancedOptions, runtime_options, responses)
+        else:
+            model = None
+            skip_load_model()
+
+    with metrics.stage("embed_responses") as stage:
+        if cached_embeddings is not None:
+            embeddings = cached_embeddings[1]["embeddings"]
+            skip_cached_stage("embed_responses")
+            time_stamps.append(
+                TimeStamp(
+                    name=progression_messages["embed_responses"], time=int(time.time())
+                )
+            )
+            stage.cached = True
+        else:
+            embeddings = embed_with_options(
+                responses, model, embedding_cache, advancedOptions, runtime_options
+            )
+            if embed_stage_cache is not None:
+                embed_stage_cache.save(
+                    "embed_responses", embed_key, {}, {"embeddings": embeddings}
+                )
+        stage.items = len(responses)
+
+    outlier_key = stage_key(
+        "detect_outliers",
+        embed_key,
+        {
+            "nearestNeighbors": advancedOptions.nearest_neighbors,
+            "zScoreThreshold": advancedOptions.z_score_threshold,
+            "neighborSearch": advancedOptions.neighbor_search,
+            "ivfProbes": advancedOptions.ivf_probes,
+            "minNeighborRecall": advancedOptions.min_neighbor_recall,
+            "seed": algorithm_settings.seed,
+        },
+    )
+    # unseeded KMeans, K sweeps and IVF searches are random by design, so
+    # their outputs are only cached when a seed makes them reproducible
+    random_stage_cache = stage_cache if algorithm_settings.seed is not None else None
+    if stage_cache is not None and random_stage_cache is None:
+        logger.info("No seed is set, the clustering stages are not cached")
+    outlier_stage_cache = (
+        stage_cache
+        if advancedOptions.neighbor_search == "exact"
+        else random_stage_cache
+    )
     if (
         advancedOptions.nearest_neighbors is not None
         and advancedOptions.z_score_threshold is not None
     ):
-        outlier_stats, responses_remaining, embeddings = detect_outliers(
-            responses,
-            embeddings,
-            advancedOptions.nearest_neighbors,
-            advancedOptions.z_score_threshold,
-        )
+        with metrics.stage("detect_outliers") as stage:
+            cached = load_cached_stage(
+                outlier_stage_cache, "detect_outliers", outlier_key
+            )
+            if cached is not None:
+                data, arrays = cached
+                outlier_stats = data["outlierStats"]
+                remaining_indexes = arrays["remaining_indexes"]
+                stage.neighbor_search = data["neighborSearch"]
+                stage.neighbor_recall = data["neighborRecall"]
+                skip_cached_stage("detect_outliers")
+                time_stamps.append(
+                    TimeStamp(
+                        name=progression_messages["detect_outliers"],
+                        time=int(time.time()),
+                    )
+                )
+                stage.cached = True
+            else:
+                (
+                    outlier_stats,
+                    remaining_indexes,
+                    stage.neighbor_search,
+                    stage.neighbor_recall,
+                ) = detect_outliers(
+                    responses,
+                    embeddings,
+                    advancedOptions.nearest_neighbors,
+                    advancedOptions.z_score_threshold,
+                    advancedOptions.neighbor_search,
+                    algorithm_settings.seed,
+                    advancedOptions.ivf_probes,
+                    advancedOptions.min_neighbor_recall,
+                )
+                if outlier_stage_cache is not None:
+                    outlier_stage_cache.save(
+                        "detect_outliers",
+                        outlier_key,
+                        {
+                            "outlierStats": outlier_stats,
+                            "neighborSearch": stage.neighbor_search,
+                            "neighborRecall": stage.neighbor_recall,
+                        },
+                        {"remaining_indexes": remaining_indexes},
+                    )
+            stage.items = len(responses)
+        # take only the remaining responses
+        responses_remaining = [responses[i] for i in remaining_indexes.tolist()]
+        embeddings = embeddings[remaining_indexes, :]
     else:
         outlier_stats = []
         responses_remaining = responses
@@ -598,9 +1077,14 @@ def main(
 
     input_file_name = os.path.basename(file_settings.path).removesuffix(".csv")
     input_file_name += f"_{time_stamps[0].time}"
+    # a resident worker can run several jobs on a file within a second
+    run_name = input_file_name
+    suffix = 2
+    while os.path.exists(os.path.join(output_dir, input_file_name)):
+        input_file_name = f"{run_name}_{suffix}"
+        suffix += 1
     result_dir = os.path.join(output_dir, input_file_name)
-    if not os.path.exists(result_dir):
-        os.mkdir(result_dir)
+    os.mkdir(result_dir)
     ###
 
     # find the number of clusters
@@ -611,35 +1095,105 @@ def main(
             max_num_clusters = min(
                 algorithm_settings.max_clusters, len(responses_remaining) // 2
             )
-        K = find_number_of_clusters(
-            embeddings,
-            max_num_clusters,
-            result_dir,
-            sample_weights,
-            algorithm_settings.seed,
+        k_search_key = stage_key(
+            "find_number_of_clusters",
+            outlier_key,
+            {
+                "maxNumClusters": max_num_clusters,
+                "seed": algorithm_settings.seed,
+                "silhouetteMetric": advancedOptions.silhouette_metric,
+                "kSearchStrategy": advancedOptions.k_search_strategy,
+                "kSearchPatience": advancedOptions.k_search_patience,
+            },
         )
+        with metrics.stage("find_number_of_clusters") as stage:
+            cached = load_cached_stage(
+                random_stage_cache, "find_number_of_clusters", k_search_key
+            )
+            search_file = result_dir + "/cluster_count_search.json"
+            if cached is not None:
+                search = cached[0]["search"]
+                with open(search_file, "w") as f:
+                    json.dump(search, f)
+                K = search["selectedK"]
+                skip_cached_stage("find_number_of_clusters")
+                time_stamps.append(
+                    TimeStamp(
+                        name=progression_messages["find_number_of_clusters"],
+                        time=int(time.time()),
+                    )
+                )
+                stage.cached = True
+            else:
+                K = find_number_of_clusters(
+                    embeddings,
+                    max_num_clusters,
+                    result_dir,
+                    sample_weights,
+                    algorithm_settings.seed,
+                    runtime_options.k_sweep_workers,
+                    advancedOptions.silhouette_metric,
+                    advancedOptions.k_search_strategy,
+                    advancedOptions.k_search_patience,
+                )
+                if random_stage_cache is not None:
+                    with open(search_file) as f:
+                        search = json.load(f)
+                    random_stage_cache.save(
+                        "find_number_of_clusters", k_search_key, {"search": search}
+                    )
+            stage.items = len(responses_remaining)
     else:
         assert algorithm_settings.cluster_count is not None
         K = algorithm_settings.cluster_count
 
-    cluster_idxs, cluster_centers = start_clustering(
-        embeddings, K, sample_weights, algorithm_settings.seed
+    clustering_key = stage_key(
+        "start_clustering", outlier_key, {"k": K, "seed": algorithm_settings.seed}
     )
+    with metrics.stage("start_clustering") as stage:
+        cached = load_cached_stage(
+            random_stage_cache, "start_clustering", clustering_key
+        )
+        if cached is not None:
+            cluster_idxs = cached[1]["labels"]
+            cluster_centers = cached[1]["centers"]
+            skip_cached_stage("cluster")
+            stage.cached = True
+        else:
+            cluster_idxs, cluster_centers = start_clustering(
+                embeddings, K, sample_weights, algorithm_settings.seed
+            )
+            if random_stage_cache is not None:
+                random_stage_cache.save(
+                    "start_clustering",
+                    clustering_key,
+                    {},
+                    {"labels": cluster_idxs, "centers": cluster_centers},
+                )
+        stage.items = len(responses_remaining)
 
     pre_merge_cluster_idxs = np.copy(cluster_idxs)
     pre_merge_centers = np.copy(cluster_centers)
 
+    # built for every run, so it can be re-merged at any threshold later
+    with metrics.stage("build_dendrogram") as stage:
+        merge_children, merge_distances = build_dendrogram(cluster_centers)
+        stage.items = K
+
     if (
         advancedOptions.similarity_threshold is not None
         and advancedOptions.similarity_threshold < 1.0
     ):
-        cluster_idxs, cluster_centers, merged_clusters = merge_clusters(
-            advancedOptions.similarity_threshold,
-            cluster_idxs,
-            cluster_centers,
-            embeddings,
-            sample_weights,
-        )
+        with metrics.stage("merge_clusters") as stage:
+            cluster_idxs, cluster_centers, merged_clusters = merge_clusters(
+                advancedOptions.similarity_threshold,
+                cluster_idxs,
+                cluster_centers,
+                embeddings,
+                sample_weights,
+                (merge_children, merge_distances),
+            )
+            stage.items = K
     else:
         merged_clusters = []
 
@@ -658,60 +1212,602 @@ def main(
     #     os.mkdir(result_dir)
     ###
     logger.info(f"RESULT_DIR: {os.path.abspath(result_dir)}")
-    print(
-        f"{RunNameMessage(name=input_file_name).model_dump_json(by_alias=True)} ",
-        flush=True,
+    print_message(RunNameMessage(name=input_file_name, job_id=current_job_id))
+
+    with metrics.stage("save_cluster_assignments"):
+        save_cluster_assignments(
+            result_dir,
+            K,
+            cluster_idxs,
+            embeddings,
+            cluster_centers,
+            responses_remaining,
+            file_settings.delimiter,
+        )
+
+    with metrics.stage("save_pairwise_similarities"):
+        save_pairwise_similarities(
+            result_dir,
+            cluster_centers,
+            file_settings.delimiter,
+            advancedOptions.similarities_format,
+            advancedOptions.similarities_top_n,
+        )
+
+    with metrics.stage("save_outliers"):
+        save_outliers(result_dir, outlier_stats)
+
+    with metrics.stage("save_excluded_words"):
+        save_excluded_words(result_dir, excluded_counts)
+
+    with metrics.stage("save_merged_clusters"):
+        save_merged_clusters(
+            result_dir,
+            merged_clusters,
+            pre_merge_cluster_idxs,
+            pre_merge_centers,
+            embeddings,
+            responses_remaining,
+        )
+
+    with metrics.stage("save_amended_file"):
+        save_amended_file(
+            file_settings.path,
+            result_dir,
+            responses_remaining,
+            file_settings.selected_columns,
+            file_settings.delimiter,
+            file_settings.has_header,
+            cluster_idxs,
+        )
+
+    with metrics.stage("save_results_bundle"):
+        save_results_bundle(
+            result_dir,
+            advancedOptions.language_model,
+            responses_remaining,
+            embeddings,
+            sample_weights,
+            pre_merge_cluster_idxs,
+            pre_merge_centers,
+            cluster_idxs,
+            cluster_centers,
+            merge_children,
+            merge_distances,
+        )
+
+    with metrics.stage("save_args"):
+        save_args(file_settings, algorithm_settings, result_dir)
+
+    # Make sure this syncs with the equivalent on the ProgressPage.tsx
+    logger.info(f"COMPLETED: {progression_messages['results']}")
+    print_progress_message("results", "DONE")
+    time_stamps.append(
+        TimeStamp(name=progression_messages["results"], time=int(time.time()))
     )
-    time.sleep(0.01)
+    save_timestamps(result_dir)
+    save_metrics(result_dir)
+    cache_hits = [stage.name for stage in metrics.stages if stage.cached]
+    if cache_hits:
+        logger.info(f"Stage cache hits: {', '.join(cache_hits)}")
+    if runtime_options.cluster_count_plot and algorithm_settings.auto_cluster_count:
+        # after the results are done, the app does not show the plot
+        save_cluster_count_plot(result_dir)
+    if metrics.profiler is not None:
+        metrics.profiler.save(result_dir)
+        metrics.profiler = None
+
+    return result_dir
+
+
+@logger.catch
+def remerge(results_dir: str, merge_threshold: Optional[float]) -> str:
+    """
+    Merges the clusters of a finished run again at another threshold, by
+    cutting the dendrogram saved in its results bundle, and rewrites the
+    outputs that depend on the merge. The language model is not loaded and
+    the responses are not re-embedded. A threshold of None or 1 undoes the
+    merge.
+    """
+    logger.info(f"Re-merging {results_dir} at threshold {merge_threshold}")
+    with open(results_dir + "/args.json") as f:
+        args = Args.model_validate_json(f.read())
+    file_settings = args.file_settings
+    advancedOptions = args.algorithm_settings.advanced_options
+
+    # loaded into memory, so the labels and centers can be replaced below
+    bundle = load_results_bundle(results_dir, mmap_mode=None)
+    responses = decode_strings(bundle["response_bytes"], bundle["response_offsets"])
+    embeddings = bundle["embeddings"]
+    # the weights are response counts, stored as float32
+    sample_weights = bundle["sample_weights"].astype(np.int64)
+    pre_merge_cluster_idxs = bundle["pre_merge_labels"]
+    pre_merge_centers = bundle["pre_merge_centers"]
+    if "merge_children" in bundle:
+        dendrogram = (bundle["merge_children"], bundle["merge_distances"])
+    else:
+        # bundles of older runs have no dendrogram yet
+        dendrogram = build_dendrogram(pre_merge_centers)
+
+    if merge_threshold is not None and merge_threshold < 1.0:
+        cluster_idxs, cluster_centers, merged_clusters = merge_clusters(
+            merge_threshold,
+            pre_merge_cluster_idxs,
+            pre_merge_centers,
+            embeddings,
+            sample_weights,
+            dendrogram,
+        )
+    else:
+        cluster_idxs = pre_merge_cluster_idxs
+        cluster_centers = pre_merge_centers
+        merged_clusters = []
 
     save_cluster_assignments(
+        results_dir,
+        len(pre_merge_centers),
+        cluster_idxs,
+        embeddings,
+        cluster_centers,
+        responses,
+        file_settings.delimiter,
+    )
+    save_pairwise_similarities(
+        results_dir,
+        cluster_centers,
+        file_settings.delimiter,
+        advancedOptions.similarities_format,
+        advancedOptions.similarities_top_n,
+    )
+    save_merged_clusters(
+        results_dir,
+        merged_clusters,
+        pre_merge_cluster_idxs,
+        pre_merge_centers,
+        embeddings,
+        responses,
+    )
+    if os.path.exists(file_settings.path):
+        save_amended_file(
+            file_settings.path,
+            results_dir,
+            responses,
+            file_settings.selected_columns,
+            file_settings.delimiter,
+            file_settings.has_header,
+            cluster_idxs,
+        )
+    else:
+        logger.warning(
+            f"Input file {file_settings.path} not found, output.csv was not updated"
+        )
+    update_results_bundle(results_dir, cluster_idxs, cluster_centers)
+
+    advancedOptions.similarity_threshold = merge_threshold
+    advancedOptions.agglomerative_clustering = (
+        merge_threshold is not None and merge_threshold < 1.0
+    )
+    save_args(file_settings, args.algorithm_settings, results_dir)
+    logger.info(f"Re-merged {results_dir} into {len(cluster_centers)} clusters")
+    return results_dir
+
+
+def nearest_centers(
+    embeddings_normalized: np.ndarray, centers_normalized: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Index of and cosine similarity to the nearest center of every response."""
+    S = np.dot(embeddings_normalized, centers_normalized.T)
+    cluster_idxs = np.argmax(S, axis=1)
+    return cluster_idxs, S[np.arange(len(S)), cluster_idxs]
+
+
+def save_assignments(
+    results_dir: str,
+    K: int,
+    cluster_idxs: np.ndarray,
+    embeddings_normalized: np.ndarray,
+    centers_normalized: np.ndarray,
+    responses: list[str],
+    outlier_bools: np.ndarray,
+    col_delimiter: str = ",",
+):
+    # like cluster_assignments.csv, with the outliers flagged instead of removed
+    output_file = f"{results_dir}/assignments.csv"
+    order, sim = rank_by_similarity_to_center(
+        cluster_idxs, embeddings_normalized, centers_normalized, K
+    )
+    with open(output_file, "w", encoding="utf-8") as f:
+        writer = csv.writer(f, delimiter=col_delimiter, lineterminator="\n")
+        writer.writerow(
+            ["response", "cluster_index", "similarity_to_center", "outlier"]
+        )
+        writer.writerows(
+            zip(
+                [responses[i] for i in order.tolist()],
+                cluster_idxs[order].tolist(),
+                sim[order].tolist(),
+                outlier_bools[order].tolist(),
+            )
+        )
+
+
+@logger.catch
+def assign(
+    input_file_path: str,
+    source_results_dir: str,
+    output_dir: str,
+    min_similarity: Optional[float] = None,
+    runtime_options: RuntimeOptions = RuntimeOptions(),
+) -> str:
+    """
+    Assigns the responses of a new input file to the clusters of a finished
+    run instead of clustering them again, so the cluster indexes of every
+    wave of a survey match those of the original run.
+
+    The new file is read with the file settings and excluded words of the
+    original run, so it must have the same layout. Every response is
+    assigned to its most similar (merged) center of the original run. It is
+    flagged as an outlier if that similarity is below min_similarity, or by
+    default below the least similar response the original run put into the
+    cluster. Outliers get no cluster index in output.csv, like the outliers
+    of a clustering run.
+    """
+    logger.info(f"Assigning {input_file_path} to the clusters of {source_results_dir}")
+    with open(source_results_dir + "/args.json") as f:
+        source_args = Args.model_validate_json(f.read())
+    file_settings = source_args.file_settings.model_copy(
+        update={"path": input_file_path}
+    )
+    algorithm_settings = source_args.algorithm_settings
+    advancedOptions = algorithm_settings.advanced_options
+
+    bundle = load_results_bundle(source_results_dir)
+    centers = np.asarray(bundle["centers"])
+    K = len(centers)
+    if min_similarity is None:
+        # the similarity of the least similar original member of every
+        # cluster, computed like the similarities of the new responses
+        source_labels = np.asarray(bundle["labels"])
+        S = np.dot(bundle["embeddings"], centers.T)
+        thresholds = np.full(K, np.inf, dtype=S.dtype)
+        np.minimum.at(thresholds, source_labels, S[np.arange(len(S)), source_labels])
+    else:
+        thresholds = np.full(K, min_similarity)
+
+    responses, _, _ = process_input_file(
+        file_settings=file_settings,
+        excluded_words=algorithm_settings.excluded_words,
+        excluded_words_mode=algorithm_settings.excluded_words_mode,
+    )
+    embedding_cache = open_embedding_cache(advancedOptions, runtime_options)
+    if embedding_cache is None or embedding_cache.missing(responses):
+        model = load_embedding_model(advancedOptions, runtime_options, responses)
+    else:
+        model = None
+        skip_load_model()
+    embeddings = embed_with_options(
+        responses, model, embedding_cache, advancedOptions, runtime_options
+    )
+    if embeddings.shape[1] != centers.shape[1]:
+        raise ValueError(
+            f"The embeddings of {advancedOptions.language_model} have "
+            f"{embeddings.shape[1]} dimensions, the centers {centers.shape[1]}"
+        )
+
+    cluster_idxs, similarities = nearest_centers(embeddings, centers)
+    outlier_bools = similarities < thresholds[cluster_idxs]
+    logger.info(
+        f"Assigned {len(responses)} responses to {K} clusters, "
+        f"{int(outlier_bools.sum())} outliers"
+    )
+
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    input_file_name = os.path.basename(input_file_path).removesuffix(".csv")
+    result_dir = os.path.join(output_dir, f"{input_file_name}_{int(time.time())}")
+    if not os.path.exists(result_dir):
+        os.mkdir(result_dir)
+
+    save_assignments(
         result_dir,
         K,
         cluster_idxs,
         embeddings,
-        cluster_centers,
-        responses_remaining,
+        centers,
+        responses,
+        outlier_bools,
+        file_settings.delimiter,
+    )
+    remaining_indexes = np.where(np.logical_not(outlier_bools))[0]
+    save_amended_file(
+        file_settings.path,
+        result_dir,
+        [responses[i] for i in remaining_indexes.tolist()],
+        file_settings.selected_columns,
         file_settings.delimiter,
+        file_settings.has_header,
+        cluster_idxs[remaining_indexes],
     )
+    with open(result_dir + "/assignment.json", "w") as f:
+        json.dump(
+            {
+                "sourceResultsDir": os.path.abspath(source_results_dir),
+                "inputFile": os.path.abspath(input_file_path),
+                "minSimilarity": min_similarity,
+                "responses": len(responses),
+                "outliers": int(outlier_bools.sum()),
+            },
+            f,
+        )
+    logger.info(f"RESULT_DIR: {os.path.abspath(result_dir)}")
+    return result_dir
+
 
-    save_pairwise_similarities(result_dir, cluster_centers, file_settings.delimiter)
+ONLINE_RESULTS_DIR = "results"
 
-    save_outliers(result_dir, outlier_stats)
 
+@logger.catch
+def update_online(
+    input_file_path: str,
+    state_dir: str,
+    file_settings: FileSettings,
+    algorithm_settings: AlgorithmSettings,
+    emit_every: int = 10,
+    runtime_options: RuntimeOptions = RuntimeOptions(),
+) -> str:
+    """
+    Adds the responses of an input file to the online clustering kept in
+    state_dir, creating it with cluster_count clusters on the first update.
+    Only the new responses are embedded and the centers are updated with
+    them alone (see OnlineSphericalKMeans), so an update costs time
+    proportional to the batch, not to all responses so far.
+
+    The settings of the first update are kept for all later ones, only the
+    input file changes. Every emit_every updates, and as soon as the first
+    centers exist, the result files of a clustering run are written to
+    <state_dir>/results from all responses so far.
+    """
+    state = OnlineClusteringState.load(state_dir)
+    if state is None:
+        assert algorithm_settings.cluster_count is not None
+        if algorithm_settings.advanced_options.outlier_detection:
+            logger.warning("Outliers are not detected in online clustering")
+        # online clustering has a fixed K and no outlier detection
+        algorithm_settings = algorithm_settings.model_copy(
+            update={
+                "auto_cluster_count": False,
+                "advanced_options": algorithm_settings.advanced_options.model_copy(
+                    update={
+                        "outlier_detection": False,
+                        "nearest_neighbors": None,
+                        "z_score_threshold": None,
+                    }
+                ),
+            }
+        )
+        state = OnlineClusteringState.create(
+            state_dir,
+            algorithm_settings.cluster_count,
+            algorithm_settings.seed,
+            Args(
+                file_settings=file_settings,
+                algorithm_settings=algorithm_settings,
+                results_dir=os.path.join(state_dir, ONLINE_RESULTS_DIR),
+            ).model_dump(by_alias=True),
+        )
+    args = Args.model_validate(state.info["settings"])
+    file_settings = args.file_settings.model_copy(update={"path": input_file_path})
+    algorithm_settings = args.algorithm_settings
+    advancedOptions = algorithm_settings.advanced_options
+
+    responses, response_counts, excluded_counts = process_input_file(
+        file_settings=file_settings,
+        excluded_words=algorithm_settings.excluded_words,
+        excluded_words_mode=algorithm_settings.excluded_words_mode,
+    )
+    results_dir = os.path.join(state_dir, ONLINE_RESULTS_DIR)
+    if not responses:
+        logger.warning(f"No responses in {input_file_path}, nothing to update")
+        return results_dir
+    embedding_cache = open_embedding_cache(advancedOptions, runtime_options)
+    if embedding_cache is None or embedding_cache.missing(responses):
+        model = load_embedding_model(advancedOptions, runtime_options, responses)
+    else:
+        model = None
+        skip_load_model()
+    embeddings = embed_with_options(
+        responses, model, embedding_cache, advancedOptions, runtime_options
+    )
+
+    was_initialized = state.kmeans.initialized
+    state.add_batch(responses, response_counts, embeddings)
+    for term, count in excluded_counts.items():
+        state.info["excludedCounts"][term] = (
+            state.info["excludedCounts"].get(term, 0) + count
+        )
+    state.save()
+    logger.info(
+        f"Online update {state.info['updates']}: added {len(responses)} responses"
+    )
+
+    if state.kmeans.initialized and (
+        not was_initialized or state.info["updates"] % max(emit_every, 1) == 0
+    ):
+        save_online_results(state, file_settings, algorithm_settings, results_dir)
+    return results_dir
+
+
+def save_online_results(
+    state: OnlineClusteringState,
+    file_settings: FileSettings,
+    algorithm_settings: AlgorithmSettings,
+    results_dir: str,
+):
+    # the result files of main(), from every response received so far.
+    # output.csv amends the most recent input file
+    logger.info(f"STARTED: {progression_messages['results']}")
+    print_progress_message("results", "STARTED")
+    advancedOptions = algorithm_settings.advanced_options
+    responses, embeddings, sample_weights = state.load_batches()
+    centers = state.kmeans.centers
+    assert centers is not None
+    K = state.kmeans.K
+    pre_merge_cluster_idxs = state.kmeans.predict(embeddings)
+    pre_merge_centers = centers.astype(embeddings.dtype)
+    merge_children, merge_distances = build_dendrogram(pre_merge_centers)
+    if (
+        advancedOptions.similarity_threshold is not None
+        and advancedOptions.similarity_threshold < 1.0
+    ):
+        cluster_idxs, cluster_centers, merged_clusters = merge_clusters(
+            advancedOptions.similarity_threshold,
+            pre_merge_cluster_idxs,
+            pre_merge_centers,
+            embeddings,
+            sample_weights,
+            (merge_children, merge_distances),
+        )
+    else:
+        cluster_idxs = pre_merge_cluster_idxs
+        cluster_centers = pre_merge_centers
+        merged_clusters = []
+
+    os.makedirs(results_dir, exist_ok=True)
+    save_cluster_assignments(
+        results_dir,
+        K,
+        cluster_idxs,
+        embeddings,
+        cluster_centers,
+        responses,
+        file_settings.delimiter,
+    )
+    save_pairwise_similarities(
+        results_dir,
+        cluster_centers,
+        file_settings.delimiter,
+        advancedOptions.similarities_format,
+        advancedOptions.similarities_top_n,
+    )
+    save_outliers(results_dir, [])
+    save_excluded_words(results_dir, state.info["excludedCounts"])
     save_merged_clusters(
-        result_dir,
+        results_dir,
         merged_clusters,
         pre_merge_cluster_idxs,
         pre_merge_centers,
         embeddings,
-        responses_remaining,
+        responses,
     )
-
     save_amended_file(
-        input_file_name,
-        result_dir,
-        responses_remaining,
-        rows,
+        file_settings.path,
+        results_dir,
+        responses,
         file_settings.selected_columns,
         file_settings.delimiter,
         file_settings.has_header,
         cluster_idxs,
     )
-
-    save_args(file_settings, algorithm_settings, result_dir)
-
-    # Make sure this syncs with the equivalent on the ProgressPage.tsx
+    save_results_bundle(
+        results_dir,
+        advancedOptions.language_model,
+        responses,
+        embeddings,
+        sample_weights,
+        pre_merge_cluster_idxs,
+        pre_merge_centers,
+        cluster_idxs,
+        cluster_centers,
+        merge_children,
+        merge_distances,
+    )
+    save_args(file_settings, algorithm_settings, results_dir)
     logger.info(f"COMPLETED: {progression_messages['results']}")
     print_progress_message("results", "DONE")
-    time_stamps.append(
-        TimeStamp(name=progression_messages["results"], time=int(time.time()))
-    )
-    save_timestamps(result_dir)
-
-    return result_dir
+    logger.info(f"RESULT_DIR: {os.path.abspath(results_dir)}")
+
+
+def raw_job_id(line: str) -> Optional[str]:
+    # the jobId of a job line that is not a valid ClusteringJob, if it has one
+    try:
+        job_id = json.loads(line).get("jobId")
+    except (ValueError, AttributeError):
+        return None
+    return job_id if isinstance(job_id, str) else None
+
+
+def run_worker(runtime_options: RuntimeOptions):
+    """
+    Resident worker mode: reads one ClusteringJob as JSON per line from stdin
+    and runs the jobs one after another in this process, so imports and
+    loaded language models are reused between runs.
+    """
+    global current_job_id
+    logger.info("Worker started")
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = ClusteringJob.model_validate_json(line)
+        except ValidationError as e:
+            logger.error(f"Invalid job: {e}")
+            # report the error for the job the line was meant to be, so the
+            # app does not discard it as a message for a stale job
+            print_job_message(raw_job_id(line), "ERROR")
+            continue
+        logger.info(f"Starting job: {job.job_id}")
+        print_job_message(job.job_id, "STARTED")
+        logger.debug(job.model_dump_json(by_alias=True))
+        current_job_id = job.job_id
+        try:
+            result_dir = main(
+                file_settings=job.file_settings,
+                algorithm_settings=job.algorithm_settings,
+                output_dir=job.output_dir,
+                runtime_options=runtime_options,
+            )
+        finally:
+            current_job_id = None
+        if result_dir:
+            print_job_message(job.job_id, "DONE", os.path.abspath(result_dir))
+        else:
+            print_job_message(job.job_id, "ERROR")
+    logger.info("Worker stopped")
 
 
 def validate_args(args):
+    if args.worker:
+        return
+    if args.remerge is not None:
+        if not os.path.exists(os.path.join(args.remerge, "args.json")):
+            print(f"Error: {args.remerge} is not a result directory.")
+            sys.exit(1)
+        return
+    if args.online is not None:
+        if args.path is None:
+            print("Error: path must be set if --online is set.")
+            sys.exit(1)
+        if args.online_emit_every < 1:
+            print("Error: --online_emit_every must be at least 1.")
+            sys.exit(1)
+        if args.cluster_count is None and not os.path.exists(
+            os.path.join(args.online, CHECKPOINT_FILE)
+        ):
+            print("Error: --cluster_count must be set for the first --online update.")
+            sys.exit(1)
+        return
+    if args.assign is not None:
+        if args.path is None:
+            print("Error: path must be set if --assign is set.")
+            sys.exit(1)
+        if not os.path.exists(os.path.join(args.assign, "args.json")):
+            print(f"Error: {args.assign} is not a result directory.")
+            sys.exit(1)
+        return
+    if args.path is None:
+        print("Error: path must be set if --worker is not set.")
+        sys.exit(1)
     if args.nearest_neighbors is not None and args.z_score_threshold is None:
         print("Error: --z_score_threshold must be set if --nearest_neighbors is set.")
         sys.exit(1)
@@ -724,16 +1820,69 @@ def validate_args(args):
     if not args.automatic_k and args.cluster_count is None:
         print("Error: --cluster_count must be set if --automatic_k is not set.")
         sys.exit(1)
+    if args.embedding_batch_size < 1:
+        print("Error: --embedding_batch_size must be at least 1.")
+        sys.exit(1)
+    if args.max_seq_length is not None and args.max_seq_length < 1:
+        print("Error: --max_seq_length must be at least 1.")
+        sys.exit(1)
+    if args.similarities_top_n < 1:
+        print("Error: --similarities_top_n must be at least 1.")
+        sys.exit(1)
+    if args.ivf_probes < 1:
+        print("Error: --ivf_probes must be at least 1.")
+        sys.exit(1)
+    if not 0 <= args.min_neighbor_recall <= 1:
+        print("Error: --min_neighbor_recall must be between 0 and 1.")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
+    # the embedding processes are spawned from the frozen executable
+    multiprocessing.freeze_support()
     parser = argparse.ArgumentParser(description="Word Clustering Tool for SocPsych")
 
     parser.add_argument(
         "path",
         type=str,
+        nargs="?",
         help="Path to the input file",
     )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run as a resident worker that reads clustering jobs as JSON lines from stdin",
+    )
+    parser.add_argument(
+        "--assign",
+        type=str,
+        metavar="RESULT_DIR",
+        help="Assign the responses of the input file to the clusters of a finished run instead of clustering them. The input file must have the layout of the original one",
+    )
+    parser.add_argument(
+        "--min_similarity",
+        type=float,
+        required=False,
+        help="Flag responses less similar to their cluster center as outliers with --assign (default: the lowest similarity within the cluster in the original run)",
+    )
+    parser.add_argument(
+        "--online",
+        type=str,
+        metavar="STATE_DIR",
+        help="Add the responses of the input file to the online clustering kept in STATE_DIR, which is created with --cluster_count clusters and the other settings of the first update",
+    )
+    parser.add_argument(
+        "--online_emit_every",
+        type=int,
+        default=10,
+        help="Write the result files of an online clustering to STATE_DIR/results every this many updates (default: 10)",
+    )
+    parser.add_argument(
+        "--remerge",
+        type=str,
+        metavar="RESULT_DIR",
+        help="Merge the clusters of a finished run again at --merge_threshold (no merging if it is not set) and rewrite its results, without loading the language model",
+    )
     parser.add_argument(
         "--output_dir",
         type=str,
@@ -803,6 +1952,13 @@ if __name__ == "__main__":
         default=[],
         help="List of words to exclude from clustering (default: [])",
     )
+    parser.add_argument(
+        "--excluded_words_mode",
+        type=str,
+        choices=EXCLUDED_WORDS_MODES,
+        default="substring",
+        help="Exclude responses that contain an excluded word anywhere, as a whole word, or that consist only of it (default: substring)",
+    )
 
     # Advanced Options
     parser.add_argument(
@@ -811,6 +1967,19 @@ if __name__ == "__main__":
         default="BAAI/bge-large-en-v1.5",
         help="Language model to use for embedding (default: BAAI/bge-large-en-v1.5)",
     )
+    parser.add_argument(
+        "--max_seq_length",
+        type=int,
+        required=False,
+        help="Truncate responses to this many tokens before embedding (default: the limit of the language model)",
+    )
+    parser.add_argument(
+        "--embedding_backend",
+        type=str,
+        choices=EMBEDDING_BACKENDS,
+        default="torch",
+        help="Run the language model with PyTorch, or as an int8 quantized ONNX model on ONNX Runtime CPU that is exported on first use (default: torch)",
+    )
     parser.add_argument(
         "--nearest_neighbors",
         type=int,
@@ -823,12 +1992,141 @@ if __name__ == "__main__":
         required=False,
         help="Threshold for outlier detection",
     )
+    parser.add_argument(
+        "--neighbor_search",
+        type=str,
+        choices=NEIGHBOR_SEARCHES,
+        default="exact",
+        help="Nearest neighbor search for outlier detection. ivf is an approximate index for very large inputs that reports its recall against the exact search (default: exact)",
+    )
+    parser.add_argument(
+        "--ivf_probes",
+        type=int,
+        default=IVF_PROBES,
+        help=f"Number of inverted lists the ivf neighbor search compares every response to, more probes raise its recall and cost (default: {IVF_PROBES})",
+    )
+    parser.add_argument(
+        "--min_neighbor_recall",
+        type=float,
+        default=MIN_NEIGHBOR_RECALL,
+        help=f"Sampled recall below which the ivf neighbor search is discarded in favor of the exact search, 0 to always keep it (default: {MIN_NEIGHBOR_RECALL})",
+    )
     parser.add_argument(
         "--merge_threshold",
         type=float,
         required=False,
         help="Threshold for merging clusters (between 0 and 1)",
     )
+    parser.add_argument(
+        "--k_search",
+        type=str,
+        choices=SEARCH_STRATEGIES,
+        default="grid",
+        help="Strategy for finding the number of clusters: the full grid, a coarse grid refined around the best K, a golden-section search, or the grid with early stopping (default: grid)",
+    )
+    parser.add_argument(
+        "--k_search_patience",
+        type=int,
+        default=5,
+        help="Number of Ks past the best one after which the early_stopping search stops (default: 5)",
+    )
+    parser.add_argument(
+        "--silhouette_metric",
+        type=str,
+        choices=SILHOUETTE_METRICS,
+        default="cosine",
+        help="Silhouette score used to find the number of clusters. cosine and weighted_cosine (counting every response as often as it was given) scale linearly with the number of responses, euclidean builds the full pairwise distance matrix (default: cosine)",
+    )
+    parser.add_argument(
+        "--similarities_format",
+        type=str,
+        choices=SIMILARITIES_FORMATS,
+        default="full",
+        help="Save the similarities between all pairs of clusters, or only the most similar clusters of every cluster (default: full)",
+    )
+    parser.add_argument(
+        "--similarities_top_n",
+        type=int,
+        default=10,
+        help="Number of most similar clusters to save per cluster with --similarities_format top_n (default: 10)",
+    )
+
+    # Runtime Options
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache response embeddings in (default: no embedding cache)",
+    )
+    parser.add_argument(
+        "--embedding_cache_max_mb",
+        type=int,
+        default=2048,
+        help="Maximum size of the embedding cache per language model in MB (default: 2048)",
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="Always embed all responses and do not touch the embedding cache",
+    )
+    parser.add_argument(
+        "--stage_cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache the outputs of the pipeline stages in, so re-runs with changed settings resume from the first affected stage (default: no stage cache)",
+    )
+    parser.add_argument(
+        "--stage_cache_max_mb",
+        type=int,
+        default=2048,
+        help="Maximum size of the stage cache in MB (default: 2048)",
+    )
+    parser.add_argument(
+        "--no_stage_cache",
+        action="store_true",
+        help="Always run every stage and do not touch the stage cache",
+    )
+    parser.add_argument(
+        "--max_loaded_models",
+        type=int,
+        default=1,
+        help="Number of language models a worker keeps loaded (default: 1)",
+    )
+    parser.add_argument(
+        "--embedding_batch_size",
+        type=int,
+        default=32,
+        help="Number of responses per embedding batch, scaled up for short and down for long responses (default: 32)",
+    )
+    parser.add_argument(
+        "--embedding_workers",
+        type=int,
+        default=1,
+        help="Number of CPU processes that embed large inputs in parallel, each loading its own copy of the language model, 0 for one per CPU core (default: 1)",
+    )
+    parser.add_argument(
+        "--onnx_cache_dir",
+        type=str,
+        default="cache/onnx",
+        help="Directory to store the exported ONNX language models in (default: cache/onnx)",
+    )
+    parser.add_argument(
+        "--k_sweep_workers",
+        type=int,
+        default=1,
+        help="Number of parallel workers when searching the number of clusters, 0 for one per CPU core (default: 1)",
+    )
+
+    parser.add_argument(
+        "--cluster_count_plot",
+        action="store_true",
+        help="Also render the scores of the search for the number of clusters as automatic_cluster_count_evaluation.png, after the results are saved",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile every stage with cProfile and a stack sampler, saving the profiles and a collapsed-stack file for flame graphs to <result_dir>/profile",
+    )
 
     args = parser.parse_args()
 
@@ -841,6 +2139,41 @@ if __name__ == "__main__":
         logger.add(f"{args.log_dir}/main.log", rotation="10 MB", level=log_level)
     else:
         logger.add("logs/python/main.log", rotation="10 MB", level=log_level)
+    # warnings and errors are also shown in the app
+    logger.add(forward_warning, level="WARNING", format="{message}")
+
+    runtimeOptions = RuntimeOptions(
+        embedding_cache_dir=(
+            None if args.no_embedding_cache else args.embedding_cache_dir
+        ),
+        embedding_cache_max_mb=args.embedding_cache_max_mb,
+        stage_cache_dir=None if args.no_stage_cache else args.stage_cache_dir,
+        stage_cache_max_mb=args.stage_cache_max_mb,
+        max_loaded_models=args.max_loaded_models,
+        k_sweep_workers=args.k_sweep_workers,
+        embedding_batch_size=args.embedding_batch_size,
+        embedding_workers=args.embedding_workers,
+        onnx_cache_dir=args.onnx_cache_dir,
+        profile=args.profile,
+        cluster_count_plot=args.cluster_count_plot,
+    )
+    logger.debug(runtimeOptions.model_dump_json(by_alias=True))
+
+    if args.worker:
+        run_worker(runtimeOptions)
+        sys.exit(0)
+
+    if args.remerge is not None:
+        if not remerge(args.remerge, args.merge_threshold):
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.assign is not None:
+        if not assign(
+            args.path, args.assign, args.output_dir, args.min_similarity, runtimeOptions
+        ):
+            sys.exit(1)
+        sys.exit(0)
 
     fileSettings = FileSettings(
         path=args.path,
@@ -861,6 +2194,16 @@ if __name__ == "__main__":
         agglomerative_clustering=agglomerative_clustering,
         similarity_threshold=args.merge_threshold,
         language_model=args.language_model,
+        neighbor_search=args.neighbor_search,
+        ivf_probes=args.ivf_probes,
+        min_neighbor_recall=args.min_neighbor_recall,
+        silhouette_metric=args.silhouette_metric,
+        k_search_strategy=args.k_search,
+        k_search_patience=args.k_search_patience,
+        similarities_format=args.similarities_format,
+        similarities_top_n=args.similarities_top_n,
+        max_seq_length=args.max_seq_length,
+        embedding_backend=args.embedding_backend,
     )
 
     algorithmSettings = AlgorithmSettings(
@@ -869,14 +2212,28 @@ if __name__ == "__main__":
         cluster_count=args.cluster_count,
         seed=args.seed,
         excluded_words=args.excluded_words,
+        excluded_words_mode=args.excluded_words_mode,
         advanced_options=advancedOptions,
     )
     logger.debug(algorithmSettings.model_dump_json(by_alias=True))
 
+    if args.online is not None:
+        if not update_online(
+            args.path,
+            args.online,
+            fileSettings,
+            algorithmSettings,
+            args.online_emit_every,
+            runtimeOptions,
+        ):
+            sys.exit(1)
+        sys.exit(0)
+
     result_dir = main(
         file_settings=fileSettings,
         algorithm_settings=algorithmSettings,
         output_dir=args.output_dir,
+        runtime_options=runtimeOptions,
     )
     if not result_dir:
         sys.exit(1)
@@ -0,0 +1,197 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from models import StageMetrics
+from profiling import StageProfiler
+
+# seconds between two samples of the resident memory during a stage
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident memory of this process right now, None if unavailable."""
+    try:
+        if sys.platform == "win32":
+            import ctypes
+            from ctypes import wintypes
+
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [
+                    ("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters),
+                counters.cb,
+            ):
+                return None
+            return counters.WorkingSetSize
+
+        if sys.platform == "darwin":
+            import ctypes
+
+            class MachTaskBasicInfo(ctypes.Structure):
+                _fields_ = [
+                    ("virtual_size", ctypes.c_uint64),
+                    ("resident_size", ctypes.c_uint64),
+                    ("resident_size_max", ctypes.c_uint64),
+                    ("user_time", ctypes.c_int * 2),
+                    ("system_time", ctypes.c_int * 2),
+                    ("policy", ctypes.c_int),
+                    ("suspend_count", ctypes.c_int),
+                ]
+
+            MACH_TASK_BASIC_INFO = 20
+            libc = ctypes.CDLL(None)
+            info = MachTaskBasicInfo()
+            count = ctypes.c_uint(ctypes.sizeof(info) // 4)
+            if libc.task_info(
+                ctypes.c_uint.in_dll(libc, "mach_task_self_"),
+                MACH_TASK_BASIC_INFO,
+                ctypes.byref(info),
+                ctypes.byref(count),
+            ):
+                return None
+            return info.resident_size
+
+        # resident pages are the second field of statm
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (ImportError, AttributeError, OSError, ValueError):
+        return None
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples the resident memory every RSS_SAMPLE_INTERVAL seconds while a
+    stage runs, so the stage reports its own peak rather than the peak of
+    the whole process so far, which also spans earlier stages and, in the
+    resident worker, earlier jobs. Peaks shorter than the interval can be
+    missed. One sampler serves all stages and idles between them.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self.active = threading.Event()
+        self.lock = threading.Lock()
+
+    def sample(self):
+        rss = current_rss_bytes()
+        with self.lock:
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def run(self):
+        while True:
+            self.active.wait()
+            self.sample()
+            time.sleep(self.interval)
+
+    def reset(self):
+        # start the peak of a new stage
+        with self.lock:
+            self.peak = None
+        self.sample()
+        self.active.set()
+
+    def pause(self) -> Optional[int]:
+        """Stops sampling and returns the peak since the last reset."""
+        self.active.clear()
+        self.sample()
+        return self.peak
+
+
+# CPU seconds spent in worker processes, e.g. the embedding pool, which the
+# workers report with every result because the pool outlives the stages
+child_cpu_time = 0.0
+child_cpu_time_lock = threading.Lock()
+
+
+def add_child_cpu_time(seconds: float):
+    global child_cpu_time
+    with child_cpu_time_lock:
+        child_cpu_time += seconds
+
+
+class StageMeasurement:
+    # set items inside the with block to record how much work the stage did,
+    # cached if its outputs were loaded from the stage cache, and
+    # neighbor_search and neighbor_recall if it searched nearest neighbors
+    def __init__(self):
+        self.items: Optional[int] = None
+        self.cached = False
+        self.neighbor_search: Optional[str] = None
+        self.neighbor_recall: Optional[float] = None
+
+
+class MetricsRecorder:
+    """
+    Records the wall time (perf_counter), CPU time (all threads of this
+    process plus the reported time of worker processes), peak resident
+    memory of this process during the stage and item count of every
+    pipeline stage run inside stage(). Every finished stage is also passed
+    to the callback, e.g. to stream it to the app. Stages are only profiled
+    while a profiler is set.
+    """
+
+    def __init__(self, callback: Optional[Callable[[StageMetrics], None]] = None):
+        self.callback = callback
+        self.stages: list[StageMetrics] = []
+        self.profiler: Optional[StageProfiler] = None
+        self.rss_sampler: Optional[RssSampler] = None
+
+    def clear(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMeasurement]:
+        measurement = StageMeasurement()
+        if self.profiler is not None:
+            self.profiler.start(name)
+        if self.rss_sampler is None:
+            self.rss_sampler = RssSampler()
+            self.rss_sampler.start()
+        self.rss_sampler.reset()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        start_child_cpu = child_cpu_time
+        try:
+            yield measurement
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+            peak_rss = self.rss_sampler.pause()
+            metrics = StageMetrics(
+                name=name,
+                wall_time=time.perf_counter() - start_wall,
+                cpu_time=time.process_time()
+                - start_cpu
+                + child_cpu_time
+                - start_child_cpu,
+                peak_rss_mb=None if peak_rss is None else peak_rss / 1024**2,
+                items=measurement.items,
+                cached=measurement.cached,
+                neighbor_search=measurement.neighbor_search,
+                neighbor_recall=measurement.neighbor_recall,
+            )
+            self.stages.append(metrics)
+            if self.callback is not None:
+                self.callback(metrics)
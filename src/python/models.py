@@ -21,6 +21,16 @@ class AdvancedOptions(CamelModel):
     agglomerative_clustering: bool
     similarity_threshold: Optional[float]
     language_model: str
+    neighbor_search: str = "exact"
+    ivf_probes: int = 8
+    min_neighbor_recall: float = 0.9
+    silhouette_metric: str = "cosine"
+    k_search_strategy: str = "grid"
+    k_search_patience: int = 5
+    similarities_format: str = "full"
+    similarities_top_n: int = 10
+    max_seq_length: Optional[int] = None
+    embedding_backend: str = "torch"
 
 
 class AlgorithmSettings(CamelModel):
@@ -29,9 +39,25 @@ class AlgorithmSettings(CamelModel):
     cluster_count: Optional[int]
     seed: Optional[int]
     excluded_words: list[str]
+    excluded_words_mode: str = "substring"
     advanced_options: AdvancedOptions
 
 
+class RuntimeOptions(CamelModel):
+    # settings that affect how fast a run is, but never its results
+    embedding_cache_dir: Optional[str] = None
+    embedding_cache_max_mb: int = 2048
+    stage_cache_dir: Optional[str] = None
+    stage_cache_max_mb: int = 2048
+    max_loaded_models: int = 1
+    k_sweep_workers: int = 1
+    embedding_batch_size: int = 32
+    embedding_workers: int = 1
+    onnx_cache_dir: str = "cache/onnx"
+    profile: bool = False
+    cluster_count_plot: bool = False
+
+
 class Args(CamelModel):
     file_settings: FileSettings
     algorithm_settings: AlgorithmSettings
@@ -40,6 +66,14 @@ class Args(CamelModel):
     results_dir: str
 
 
+class ClusteringJob(CamelModel):
+    # a single run requested from a resident worker, mirrors Args in models.ts
+    file_settings: FileSettings
+    algorithm_settings: AlgorithmSettings
+    output_dir: str
+    job_id: Optional[str] = None
+
+
 class SimilarityPair(CamelModel):
     cluster_pair: list[int]
     similarity: float
@@ -73,13 +107,65 @@ class TimeStamps(CamelModel):
     time_stamps: list[TimeStamp]
 
 
+class StageMetrics(CamelModel):
+    # wall and CPU time in seconds, the CPU time including worker processes,
+    # and the peak memory of the main process during the stage
+    name: str
+    wall_time: float
+    cpu_time: float
+    peak_rss_mb: Optional[float]
+    items: Optional[int]
+    cached: bool = False
+    # the neighbor search that produced the outliers of the stage and the
+    # sampled recall of the approximate search, if it ran
+    neighbor_search: Optional[str] = None
+    neighbor_recall: Optional[float] = None
+
+
+class StageMetricsMessage(StageMetrics):
+    type: str = "stage_metrics"
+
+
+class Metrics(CamelModel):
+    stages: list[StageMetrics]
+
+
 class ProgressMessage(CamelModel):
     step: str
     status: str
     timestamp: str
+    # the worker job the message belongs to, None outside of a worker
+    job_id: Optional[str] = None
     type: str = "progress"
 
 
+class TaskProgressMessage(CamelModel):
+    # progress within a long-running step, items per second and seconds left
+    step: str
+    done: int
+    total: int
+    rate: float
+    eta: Optional[float]
+    timestamp: str
+    job_id: Optional[str] = None
+    type: str = "task_progress"
+
+
 class RunNameMessage(CamelModel):
     name: str
+    job_id: Optional[str] = None
     type: str = "run_name"
+
+
+class WarningMessage(CamelModel):
+    level: str
+    message: str
+    timestamp: str
+    type: str = "warning"
+
+
+class JobMessage(CamelModel):
+    job_id: Optional[str]
+    status: str
+    result_dir: Optional[str] = None
+    type: str = "job"
@@ -0,0 +1,227 @@
+import time
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from progress import ProgressReporter
+
+# upper bound for the similarity block of one row chunk
+BLOCK_BYTES = 128 * 1024 * 1024
+
+
+def row_chunks(n: int, itemsize: int = 4) -> list[tuple[int, int]]:
+    """
+    Splits n rows into chunks whose similarity block against all n rows fits
+    into about BLOCK_BYTES. Chunks are never smaller than two rows, so numpy
+    never falls back to a matrix-vector product. The similarities still
+    depend on how the BLAS splits each product, so with several chunks they
+    match those of the full matrix only up to floating-point rounding.
+    """
+    chunk_size = max(BLOCK_BYTES // max(n * itemsize, 1), 2)
+    n_chunks = max(n // chunk_size, 1)
+    bounds = np.linspace(0, n, n_chunks + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def top_k_similarities(
+    norm_embeddings: np.ndarray,
+    k: int,
+    progress: Optional[ProgressReporter] = None,
+) -> np.ndarray:
+    """
+    Returns the k largest cosine similarities of every embedding to all
+    embeddings (including itself), sorted descendingly, shape (n, k).
+
+    The similarity matrix is never materialized: row chunks are streamed
+    through the matmul and only the k best similarities of each row are kept,
+    so the peak memory is O(n * k + chunk * n).
+    """
+    n = norm_embeddings.shape[0]
+    chunks = row_chunks(n, norm_embeddings.dtype.itemsize)
+    logger.debug(
+        f"Computing top {k} neighbors of {n} embeddings in {len(chunks)} chunks"
+    )
+    top = np.empty((n, k), dtype=norm_embeddings.dtype)
+    for start, stop in chunks:
+        S = np.dot(norm_embeddings[start:stop], norm_embeddings.T)
+        # the ordering in the partitions is undefined, so the k best values
+        # are sorted afterwards
+        partition = np.partition(-S, k - 1, axis=1)[:, :k]
+        top[start:stop] = -np.sort(partition, axis=1)
+        if progress is not None:
+            progress.advance(stop - start)
+    return top
+
+
+NEIGHBOR_SEARCHES = ["exact", "ivf"]
+# below this many responses the exact search is fast enough
+IVF_MIN_RESPONSES = 2000
+# number of inverted lists per square root of the number of responses
+IVF_LISTS_PER_SQRT_N = 4
+# default number of inverted lists that are searched for every response
+IVF_PROBES = 8
+# number of responses for which the recall against the exact search is measured
+RECALL_SAMPLE_SIZE = 1000
+# default sampled recall below which the approximate neighbors are discarded
+# and the exact search is run instead, so the outliers do not silently change
+MIN_NEIGHBOR_RECALL = 0.9
+
+
+def top_k_neighbors(
+    norm_embeddings: np.ndarray, k: int, rows: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Exact k most similar embeddings (similarities and indexes) for some rows."""
+    S = np.dot(norm_embeddings[rows], norm_embeddings.T)
+    idxs = np.argpartition(-S, k - 1, axis=1)[:, :k]
+    sims = np.take_along_axis(S, idxs, axis=1)
+    order = np.argsort(-sims, axis=1)
+    return np.take_along_axis(sims, order, axis=1), np.take_along_axis(
+        idxs, order, axis=1
+    )
+
+
+def ivf_top_k_neighbors(
+    norm_embeddings: np.ndarray,
+    k: int,
+    seed: Optional[int] = None,
+    progress: Optional[ProgressReporter] = None,
+    n_probes: int = IVF_PROBES,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Approximate k most similar embeddings of every embedding (including
+    itself) with an inverted file index, sorted descendingly, shape (n, k).
+
+    A coarse KMeans quantizer splits the embeddings into about 4 * sqrt(n)
+    lists. Every embedding is only compared to the members of the n_probes
+    lists whose centroids are most similar to it, which turns the O(n^2 * d)
+    exact search into roughly O(n^1.5 * d). Rows for which fewer than k
+    candidates were found are searched exactly.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    n = norm_embeddings.shape[0]
+    n_lists = min(max(int(IVF_LISTS_PER_SQRT_N * np.sqrt(n)), 1), n)
+    n_probes = min(n_probes, n_lists)
+    rng = np.random.default_rng(seed)
+
+    # train the coarse quantizer on a sample of the embeddings
+    train_size = min(n, 64 * n_lists)
+    train = norm_embeddings[np.sort(rng.choice(n, train_size, replace=False))]
+    quantizer = MiniBatchKMeans(
+        n_clusters=n_lists, random_state=seed, n_init=1, batch_size=4096
+    )
+    quantizer.fit(train)
+    centroids = quantizer.cluster_centers_.astype(norm_embeddings.dtype)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    # the lists to probe for every embedding, the first one is its own list
+    probes = np.empty((n, n_probes), dtype=np.int64)
+    chunk = max(BLOCK_BYTES // max(n_lists * norm_embeddings.dtype.itemsize, 1), 1)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        C = np.dot(norm_embeddings[start:stop], centroids.T)
+        best = np.argpartition(-C, n_probes - 1, axis=1)[:, :n_probes]
+        order = np.argsort(-np.take_along_axis(C, best, axis=1), axis=1)
+        probes[start:stop] = np.take_along_axis(best, order, axis=1)
+
+    # members of every list
+    members_order = np.argsort(probes[:, 0], kind="stable")
+    members_bounds = np.concatenate(
+        [[0], np.cumsum(np.bincount(probes[:, 0], minlength=n_lists))]
+    )
+    # queries that probe every list
+    flat_probes = probes.ravel()
+    queries_order = np.argsort(flat_probes, kind="stable")
+    queries_all = np.repeat(np.arange(n), n_probes)[queries_order]
+    queries_bounds = np.concatenate(
+        [[0], np.cumsum(np.bincount(flat_probes, minlength=n_lists))]
+    )
+
+    top_sims = np.full((n, k), -np.inf, dtype=norm_embeddings.dtype)
+    top_idxs = np.full((n, k), -1, dtype=np.int64)
+    for list_idx in range(n_lists):
+        members = members_order[members_bounds[list_idx] : members_bounds[list_idx + 1]]
+        queries = queries_all[queries_bounds[list_idx] : queries_bounds[list_idx + 1]]
+        if progress is not None:
+            # the lists partition the rows, so the progress adds up to n
+            progress.advance(len(members))
+        if len(members) == 0 or len(queries) == 0:
+            continue
+        S = np.dot(norm_embeddings[queries], norm_embeddings[members].T)
+        # merge the candidates of this list into the running top k
+        candidate_sims = np.concatenate([top_sims[queries], S], axis=1)
+        candidate_idxs = np.concatenate(
+            [top_idxs[queries], np.broadcast_to(members, S.shape)], axis=1
+        )
+        best = np.argpartition(-candidate_sims, k - 1, axis=1)[:, :k]
+        top_sims[queries] = np.take_along_axis(candidate_sims, best, axis=1)
+        top_idxs[queries] = np.take_along_axis(candidate_idxs, best, axis=1)
+
+    incomplete = np.where((top_idxs < 0).any(axis=1))[0]
+    if len(incomplete) > 0:
+        logger.debug(f"Searching {len(incomplete)} rows exactly")
+        top_sims[incomplete], top_idxs[incomplete] = top_k_neighbors(
+            norm_embeddings, k, incomplete
+        )
+
+    order = np.argsort(-top_sims, axis=1)
+    return np.take_along_axis(top_sims, order, axis=1), np.take_along_axis(
+        top_idxs, order, axis=1
+    )
+
+
+def neighbor_recall(
+    norm_embeddings: np.ndarray,
+    approximate_idxs: np.ndarray,
+    seed: Optional[int] = None,
+) -> float:
+    """Recall of approximate neighbors against the exact ones on a sample."""
+    n, k = approximate_idxs.shape
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n, min(n, RECALL_SAMPLE_SIZE), replace=False))
+    _, exact_idxs = top_k_neighbors(norm_embeddings, k, sample)
+    found = sum(
+        len(np.intersect1d(exact, approximate, assume_unique=True))
+        for exact, approximate in zip(exact_idxs, approximate_idxs[sample])
+    )
+    return found / (len(sample) * k)
+
+
+def neighbor_similarities(
+    norm_embeddings: np.ndarray,
+    k: int,
+    neighbor_search: str = "exact",
+    seed: Optional[int] = None,
+    progress: Optional[ProgressReporter] = None,
+    n_probes: int = IVF_PROBES,
+    min_recall: float = MIN_NEIGHBOR_RECALL,
+) -> tuple[np.ndarray, str, Optional[float]]:
+    """
+    The k largest similarities of every embedding (including itself), sorted
+    descendingly, the search that actually computed them and the sampled
+    recall of the approximate search (None if it did not run). If the recall
+    is below min_recall the exact similarities are returned.
+    """
+    n = norm_embeddings.shape[0]
+    if neighbor_search == "exact" or n < IVF_MIN_RESPONSES:
+        return top_k_similarities(norm_embeddings, k, progress), "exact", None
+    if neighbor_search != "ivf":
+        raise ValueError(f"Unknown neighbor search: {neighbor_search}")
+    start = time.perf_counter()
+    top_sims, top_idxs = ivf_top_k_neighbors(
+        norm_embeddings, k, seed, progress, n_probes
+    )
+    recall = neighbor_recall(norm_embeddings, top_idxs, seed)
+    if recall >= min_recall:
+        logger.info(f"Approximate neighbor search recall@{k}: {recall:.4f}")
+        return top_sims, "ivf", recall
+    logger.warning(
+        f"Approximate neighbor search recall@{k} is only {recall:.4f}, below "
+        f"{min_recall}, discarding its {time.perf_counter() - start:.1f}s and "
+        f"falling back to the exact search. Raise the number of probes or use "
+        f"the exact search for these responses"
+    )
+    if progress is not None:
+        progress.add_total(n)
+    return top_k_similarities(norm_embeddings, k, progress), "exact", recall
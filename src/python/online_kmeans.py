@@ -0,0 +1,203 @@
+import json
+import os
+from typing import Any, Optional
+
+import numpy as np
+from loguru import logger
+
+from results_bundle import decode_strings, encode_strings
+
+CHECKPOINT_FILE = "checkpoint.npz"
+BATCHES_DIR = "batches"
+CHECKPOINT_VERSION = 1
+
+
+class OnlineSphericalKMeans:
+    """
+    Mini-batch spherical KMeans over normalized embeddings.
+
+    Every batch is assigned to the most similar centers, then each center
+    moves to the weighted mean of its previous position (weighted by the
+    number of responses it has absorbed so far) and its new members, and is
+    normalized again. An update therefore costs O(batch size * K * d),
+    independent of how many responses came before.
+
+    Until K responses have arrived the batches are only buffered; the
+    centers are then initialized with k-means++ on everything buffered.
+    """
+
+    def __init__(self, K: int, seed: Optional[int] = None):
+        self.K = K
+        self.seed = seed
+        self.centers: Optional[np.ndarray] = None
+        self.counts = np.zeros(K, dtype=np.float64)
+
+    @property
+    def initialized(self) -> bool:
+        return self.centers is not None
+
+    def initialize(self, embeddings: np.ndarray, sample_weights: np.ndarray):
+        from sklearn.cluster import kmeans_plusplus
+
+        centers, _ = kmeans_plusplus(
+            np.asarray(embeddings, dtype=np.float64),
+            self.K,
+            sample_weight=np.asarray(sample_weights, dtype=np.float64),
+            random_state=self.seed,
+        )
+        self.centers = centers / np.linalg.norm(centers, axis=1, keepdims=True)
+        self.counts = np.zeros(self.K, dtype=np.float64)
+
+    def predict(self, embeddings: np.ndarray) -> np.ndarray:
+        assert self.centers is not None
+        return np.argmax(np.dot(embeddings, self.centers.T), axis=1)
+
+    def partial_fit(
+        self, embeddings: np.ndarray, sample_weights: np.ndarray
+    ) -> np.ndarray:
+        """Updates the centers with a batch and returns its labels."""
+        assert self.centers is not None
+        labels = self.predict(embeddings)
+        weights = np.asarray(sample_weights, dtype=np.float64)
+        batch_counts = np.bincount(labels, weights=weights, minlength=self.K)
+        batch_sums = np.zeros_like(self.centers)
+        np.add.at(batch_sums, labels, weights[:, None] * embeddings)
+
+        updated = batch_counts > 0
+        sums = self.counts[updated, None] * self.centers[updated] + batch_sums[updated]
+        self.centers[updated] = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+        self.counts += batch_counts
+        return labels
+
+
+class OnlineClusteringState:
+    """
+    Everything an online clustering keeps between updates in state_dir: the
+    clustering itself, the settings of the first update and bookkeeping in
+    checkpoint.npz, and the responses and embeddings of every batch in
+    batches/, from which the result files are written.
+
+    The checkpoint is replaced in one step after the batch is stored, so an
+    interrupted update leaves the previous state intact.
+    """
+
+    def __init__(self, state_dir: str, kmeans: OnlineSphericalKMeans, info: dict):
+        self.dir = state_dir
+        self.kmeans = kmeans
+        # settings, number of updates, stored batches and excluded word counts
+        self.info = info
+
+    @classmethod
+    def create(
+        cls, state_dir: str, K: int, seed: Optional[int], settings: dict[str, Any]
+    ) -> "OnlineClusteringState":
+        return cls(
+            state_dir,
+            OnlineSphericalKMeans(K, seed),
+            {
+                "version": CHECKPOINT_VERSION,
+                "settings": settings,
+                "updates": 0,
+                "batches": [],
+                "excludedCounts": {},
+            },
+        )
+
+    @classmethod
+    def load(cls, state_dir: str) -> Optional["OnlineClusteringState"]:
+        checkpoint_file = os.path.join(state_dir, CHECKPOINT_FILE)
+        if not os.path.exists(checkpoint_file):
+            return None
+        with np.load(checkpoint_file) as checkpoint:
+            info = json.loads(str(checkpoint["info"]))
+            if info["version"] != CHECKPOINT_VERSION:
+                raise ValueError(
+                    f"Unsupported online clustering checkpoint version: {info['version']}"
+                )
+            kmeans = OnlineSphericalKMeans(info["k"], info["seed"])
+            if "centers" in checkpoint:
+                kmeans.centers = checkpoint["centers"]
+            kmeans.counts = checkpoint["counts"]
+        return cls(state_dir, kmeans, info)
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        info = dict(self.info, k=self.kmeans.K, seed=self.kmeans.seed)
+        arrays = {"info": np.array(json.dumps(info)), "counts": self.kmeans.counts}
+        if self.kmeans.centers is not None:
+            arrays["centers"] = self.kmeans.centers
+        tmp_file = os.path.join(self.dir, CHECKPOINT_FILE + ".tmp.npz")
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, os.path.join(self.dir, CHECKPOINT_FILE))
+
+    def add_batch(
+        self,
+        responses: list[str],
+        response_counts: dict[str, int],
+        embeddings: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Stores a batch and updates the clustering with it, returning the
+        labels of its responses (-1 while the centers are not initialized).
+        The checkpoint has to be saved afterwards.
+        """
+        sample_weights = np.array(
+            [response_counts[r] for r in responses], dtype=np.float64
+        )
+        batch_name = f"{self.info['updates']:06d}.npz"
+        batches_dir = os.path.join(self.dir, BATCHES_DIR)
+        os.makedirs(batches_dir, exist_ok=True)
+        response_bytes, response_offsets = encode_strings(responses)
+        np.savez(
+            os.path.join(batches_dir, batch_name),
+            embeddings=np.asarray(embeddings, dtype=np.float32),
+            sample_weights=sample_weights,
+            response_bytes=response_bytes,
+            response_offsets=response_offsets,
+        )
+        self.info["batches"].append(batch_name)
+        self.info["updates"] += 1
+
+        if self.kmeans.initialized:
+            return self.kmeans.partial_fit(embeddings, sample_weights)
+
+        # buffer until there are enough responses for K centers
+        _, all_embeddings, all_weights = self.load_batches()
+        if len(all_embeddings) < self.kmeans.K:
+            logger.info(
+                f"Waiting for {self.kmeans.K} responses before clustering, "
+                f"{len(all_embeddings)} so far"
+            )
+            return np.full(len(responses), -1)
+        self.kmeans.initialize(all_embeddings, all_weights)
+        self.kmeans.partial_fit(all_embeddings, all_weights)
+        return self.kmeans.predict(embeddings)
+
+    def load_batches(self) -> tuple[list[str], np.ndarray, np.ndarray]:
+        """
+        All unique responses received so far with their embeddings and
+        summed counts, in the order they first arrived.
+        """
+        responses: list[str] = []
+        embeddings: list[np.ndarray] = []
+        weights: list[np.ndarray] = []
+        for batch_name in self.info["batches"]:
+            with np.load(os.path.join(self.dir, BATCHES_DIR, batch_name)) as batch:
+                responses.extend(
+                    decode_strings(batch["response_bytes"], batch["response_offsets"])
+                )
+                embeddings.append(batch["embeddings"])
+                weights.append(batch["sample_weights"])
+        all_embeddings = np.concatenate(embeddings)
+        all_weights = np.concatenate(weights)
+
+        # a response given in several batches is kept once, with its counts
+        first_idxs: dict[str, int] = {}
+        for i, response in enumerate(responses):
+            first_idxs.setdefault(response, i)
+        idxs = np.fromiter(first_idxs.values(), dtype=np.int64, count=len(first_idxs))
+        _, inverse = np.unique(
+            np.array([first_idxs[r] for r in responses]), return_inverse=True
+        )
+        summed_weights = np.bincount(inverse, weights=all_weights)
+        return list(first_idxs), all_embeddings[idxs], summed_weights
@@ -0,0 +1,246 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+from loguru import logger
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+EMBEDDING_BACKENDS = ["torch", "onnx_int8"]
+QUANTIZED_FILE = "model_qint8.onnx"
+AGREEMENT_FILE = "agreement.json"
+# number of responses embedded with both backends after the conversion
+AGREEMENT_SAMPLE_SIZE = 256
+# below this mean cosine similarity between both backends a warning is logged
+MIN_COSINE_AGREEMENT = 0.99
+
+
+def export_dir(onnx_cache_dir: str, language_model: str) -> str:
+    model_key = hashlib.sha256(language_model.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(onnx_cache_dir, model_key)
+
+
+def export_quantized_model(model: "SentenceTransformer", directory: str):
+    """
+    Exports the transformer of the model to ONNX and quantizes its weights
+    to int8 with dynamic quantization. The conversion happens in a temporary
+    directory, so an interrupted export is never picked up as cached. All
+    paths are absolute and the working directory is never changed, since
+    other threads of the resident worker may resolve relative paths.
+    quantize_dynamic() keeps its intermediates in temporary directories of
+    its own; only quant_pre_process(), which is not used, writes
+    sym_shape_infer_temp.onnx into the working directory.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    class TransformerOutput(torch.nn.Module):
+        # the exported graph only returns the token embeddings, pooling and
+        # normalization stay in the sentence-transformers modules
+        def __init__(self, auto_model: torch.nn.Module, input_names: list[str]):
+            super().__init__()
+            self.auto_model = auto_model
+            self.input_names = input_names
+
+        def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+            return self.auto_model(**dict(zip(self.input_names, inputs)))[0]
+
+    directory = os.path.abspath(directory)
+    tmp_dir = directory + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    fp32_file = os.path.join(tmp_dir, "model.onnx")
+
+    dummy = model.tokenizer(["export"], return_tensors="pt")
+    input_names = [
+        name
+        for name in ("input_ids", "attention_mask", "token_type_ids")
+        if name in dummy
+    ]
+    dynamic_axes = {
+        name: {0: "batch", 1: "sequence"}
+        for name in input_names + ["last_hidden_state"]
+    }
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript exporter supports dynamic_axes without onnxscript
+        export_kwargs["dynamo"] = False
+    auto_model = model[0].auto_model
+    with torch.no_grad():
+        torch.onnx.export(
+            TransformerOutput(auto_model, input_names).eval(),
+            tuple(dummy[name] for name in input_names),
+            fp32_file,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            **export_kwargs,
+        )
+        quantize_dynamic(
+            fp32_file,
+            os.path.join(tmp_dir, QUANTIZED_FILE),
+            weight_type=QuantType.QInt8,
+        )
+    # intermediate files are left in tmp_dir, only the quantized model is kept
+    for name in os.listdir(tmp_dir):
+        if name != QUANTIZED_FILE:
+            path = os.path.join(tmp_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+
+
+class OnnxSentenceEncoder:
+    """
+    Drop-in replacement for SentenceTransformer.encode() that runs the int8
+    quantized transformer on ONNX Runtime CPU. Tokenization and the pooling
+    modules of the sentence-transformers model are reused, so only the
+    transformer itself is swapped.
+    """
+
+    def __init__(
+        self,
+        model: "SentenceTransformer",
+        quantized_file: str,
+        n_threads: Optional[int] = None,
+    ):
+        import onnxruntime
+        import torch
+
+        options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = onnxruntime.InferenceSession(
+            quantized_file, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.model = model
+        self.device = torch.device("cpu")
+        self.quantized_file = quantized_file
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    @property
+    def max_seq_length(self) -> int:
+        return self.model.max_seq_length
+
+    @max_seq_length.setter
+    def max_seq_length(self, value: int):
+        self.model.max_seq_length = value
+
+    def encode(
+        self,
+        sentences: list[str],
+        batch_size: int = 32,
+        normalize_embeddings: bool = False,
+        convert_to_numpy: bool = True,
+    ) -> np.ndarray:
+        import torch
+
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            batch = [s.strip() for s in sentences[start : start + batch_size]]
+            inputs = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            feeds = {name: inputs[name].astype(np.int64) for name in self.input_names}
+            (token_embeddings,) = self.session.run(["last_hidden_state"], feeds)
+            features = {
+                "token_embeddings": torch.from_numpy(token_embeddings),
+                "attention_mask": torch.from_numpy(feeds["attention_mask"]),
+            }
+            with torch.no_grad():
+                for module in list(self.model)[1:]:
+                    features = module(features)
+            embeddings = features["sentence_embedding"]
+            if normalize_embeddings:
+                embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+            batches.append(embeddings.numpy())
+        return np.concatenate(batches)
+
+
+def cosine_agreement(a: np.ndarray, b: np.ndarray) -> tuple[float, float]:
+    """Mean and minimum cosine similarity between corresponding rows."""
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    similarities = np.sum(a * b, axis=1)
+    return float(similarities.mean()), float(similarities.min())
+
+
+# encoders kept between the jobs of a resident worker
+loaded_encoders: dict[str, OnnxSentenceEncoder] = {}
+
+
+def load_onnx_model(
+    model: "SentenceTransformer",
+    language_model: str,
+    onnx_cache_dir: str,
+    sample_responses: list[str],
+    n_threads: Optional[int] = None,
+) -> OnnxSentenceEncoder:
+    """
+    Returns an int8 ONNX Runtime encoder for the model, exporting and
+    quantizing it into onnx_cache_dir on first use. Right after the
+    conversion a sample of the responses is embedded with both backends and
+    the cosine agreement is saved next to the exported model; it is logged
+    on every load.
+    """
+    directory = export_dir(onnx_cache_dir, language_model)
+    quantized_file = os.path.join(directory, QUANTIZED_FILE)
+    agreement_file = os.path.join(directory, AGREEMENT_FILE)
+
+    if not os.path.exists(quantized_file):
+        logger.info(f"Exporting {language_model} to a quantized ONNX model")
+        export_quantized_model(model, directory)
+
+    encoder = loaded_encoders.get(quantized_file)
+    if encoder is None or encoder.model is not model:
+        encoder = OnnxSentenceEncoder(model, quantized_file, n_threads)
+        loaded_encoders[quantized_file] = encoder
+
+    if not os.path.exists(agreement_file) and sample_responses:
+        sample = sample_responses[:AGREEMENT_SAMPLE_SIZE]
+        mean, minimum = cosine_agreement(
+            model.encode(sample, convert_to_numpy=True),
+            encoder.encode(sample),
+        )
+        with open(agreement_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "languageModel": language_model,
+                    "sampleSize": len(sample),
+                    "meanCosine": mean,
+                    "minCosine": minimum,
+                },
+                f,
+                indent=4,
+            )
+
+    if os.path.exists(agreement_file):
+        with open(agreement_file, encoding="utf-8") as f:
+            agreement = json.load(f)
+        message = (
+            f"Cosine agreement of the int8 ONNX and the PyTorch embeddings of "
+            f"{language_model}: mean {agreement['meanCosine']:.4f}, "
+            f"min {agreement['minCosine']:.4f} on {agreement['sampleSize']} responses"
+        )
+        if agreement["meanCosine"] < MIN_COSINE_AGREEMENT:
+            logger.warning(message)
+        else:
+            logger.info(message)
+    return encoder
@@ -0,0 +1,104 @@
+import cProfile
+import os
+import sys
+import threading
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+from loguru import logger
+
+PROFILE_DIR = "profile"
+COLLAPSED_STACKS_FILE = "stacks.collapsed"
+# seconds between two samples of the stacks of all threads
+SAMPLE_INTERVAL = 0.005
+
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the Python stacks of all other threads every SAMPLE_INTERVAL
+    seconds and counts them per stage, as stage;thread;outermost;...;innermost.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.stage: Optional[str] = None
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            stage = self.stage
+            if stage is None:
+                continue
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                labels = []
+                current: Optional[FrameType] = frame
+                while current is not None:
+                    labels.append(frame_label(current))
+                    current = current.f_back
+                labels.append(thread_names.get(thread_id, str(thread_id)))
+                labels.append(stage)
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class StageProfiler:
+    """
+    Profiles every pipeline stage deterministically with cProfile, which only
+    sees the thread that runs the stage, and samples the stacks of all
+    threads (e.g. the K sweep workers) for a flame graph. save() writes one
+    <index>_<stage>.prof file per stage, readable with pstats or snakeviz,
+    and stacks.collapsed for flamegraph.pl or speedscope into
+    <results_dir>/profile.
+    """
+
+    def __init__(self):
+        self.profiles: list[tuple[str, cProfile.Profile]] = []
+        self.current: Optional[cProfile.Profile] = None
+        self.sampler = StackSampler()
+        self.sampler.start()
+
+    def start(self, stage: str):
+        self.current = cProfile.Profile()
+        self.profiles.append((stage, self.current))
+        self.sampler.stage = stage
+        self.current.enable()
+
+    def stop(self):
+        if self.current is not None:
+            self.current.disable()
+            self.current = None
+        self.sampler.stage = None
+
+    def close(self):
+        self.stop()
+        if self.sampler.is_alive():
+            self.sampler.stop()
+
+    def save(self, results_dir: str):
+        self.close()
+        profile_dir = os.path.join(results_dir, PROFILE_DIR)
+        os.makedirs(profile_dir, exist_ok=True)
+        for idx, (stage, profile) in enumerate(self.profiles):
+            profile.dump_stats(os.path.join(profile_dir, f"{idx:02d}_{stage}.prof"))
+        with open(
+            os.path.join(profile_dir, COLLAPSED_STACKS_FILE), "w", encoding="utf-8"
+        ) as f:
+            for stack, count in sorted(self.sampler.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Saved profiles of {len(self.profiles)} stages to {profile_dir}")
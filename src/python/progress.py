@@ -0,0 +1,53 @@
+import threading
+import time
+from typing import Callable, Optional
+
+# minimum number of seconds between two progress reports of a stage
+PROGRESS_INTERVAL = 1.0
+
+# step, done, total, items per second, estimated seconds remaining
+ProgressCallback = Callable[[str, int, int, float, Optional[float]], None]
+
+
+class ProgressReporter:
+    """
+    Counts the finished items (batches, Ks, chunks) of a long-running stage
+    and reports done/total, the rate and the estimated time remaining.
+
+    Reports are rate-limited to one per PROGRESS_INTERVAL seconds, plus one
+    when the last item is done, so advance() can be called for every item.
+    It may be called from several threads at once.
+    """
+
+    def __init__(
+        self,
+        step: str,
+        total: int,
+        callback: ProgressCallback,
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        self.step = step
+        self.total = total
+        self.callback = callback
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.last_report = float("-inf")
+        self.lock = threading.Lock()
+
+    def add_total(self, n: int):
+        # for stages that only learn along the way how much work is left
+        with self.lock:
+            self.total += n
+
+    def advance(self, n: int = 1):
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if self.done < self.total and now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            elapsed = now - self.start_time
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            eta = (self.total - self.done) / rate if rate > 0 else None
+            self.callback(self.step, self.done, self.total, rate, eta)
@@ -0,0 +1,123 @@
+import json
+import os
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+BUNDLE_DIR = "bundle"
+BUNDLE_VERSION = 1
+
+
+def encode_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Packs strings into one utf-8 byte buffer and the offsets of every string
+    in it, string i being buffer[offsets[i] : offsets[i + 1]].
+    """
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(buffer: np.ndarray, offsets: np.ndarray) -> list[str]:
+    data = buffer.tobytes()
+    bounds = offsets.tolist()
+    return [
+        data[start:stop].decode("utf-8") for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def save_results_bundle(
+    results_dir: str,
+    language_model: str,
+    responses: list[str],
+    embeddings: np.ndarray,
+    sample_weights: np.ndarray,
+    pre_merge_cluster_idxs: np.ndarray,
+    pre_merge_centers: np.ndarray,
+    cluster_idxs: np.ndarray,
+    centers: np.ndarray,
+    merge_children: np.ndarray,
+    merge_distances: np.ndarray,
+):
+    """
+    Saves the arrays of a run as uncompressed .npy files in
+    <results_dir>/bundle, so they can be memory-mapped with
+    load_results_bundle() instead of re-embedding the responses or parsing
+    the text outputs. Row i of every per-response array belongs to the
+    i-th response (after outlier removal). merge_children and
+    merge_distances are the dendrogram of the pre-merge centers.
+    """
+    bundle_dir = os.path.join(results_dir, BUNDLE_DIR)
+    os.makedirs(bundle_dir, exist_ok=True)
+    response_bytes, response_offsets = encode_strings(responses)
+    arrays = {
+        "embeddings": np.asarray(embeddings, dtype=np.float32),
+        "sample_weights": np.asarray(sample_weights, dtype=np.float32),
+        "pre_merge_labels": np.asarray(pre_merge_cluster_idxs, dtype=np.int32),
+        "pre_merge_centers": np.asarray(pre_merge_centers, dtype=np.float32),
+        "labels": np.asarray(cluster_idxs, dtype=np.int32),
+        "centers": np.asarray(centers, dtype=np.float32),
+        "merge_children": np.asarray(merge_children, dtype=np.int64),
+        "merge_distances": np.asarray(merge_distances, dtype=np.float64),
+        "response_bytes": response_bytes,
+        "response_offsets": response_offsets,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(bundle_dir, f"{name}.npy"), array)
+    write_manifest(
+        bundle_dir,
+        {
+            "version": BUNDLE_VERSION,
+            "languageModel": language_model,
+            "responses": len(responses),
+            "arrays": {},
+        },
+        arrays,
+    )
+    logger.debug(f"Saved results bundle to {bundle_dir}")
+
+
+def write_manifest(bundle_dir: str, manifest: dict, arrays: dict[str, np.ndarray]):
+    manifest["arrays"].update(
+        {
+            name: {"dtype": str(array.dtype), "shape": list(array.shape)}
+            for name, array in arrays.items()
+        }
+    )
+    with open(os.path.join(bundle_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def update_results_bundle(results_dir: str, labels: np.ndarray, centers: np.ndarray):
+    # replaces the merged labels and centers, e.g. after re-merging a run
+    bundle_dir = os.path.join(results_dir, BUNDLE_DIR)
+    with open(os.path.join(bundle_dir, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    arrays = {
+        "labels": np.asarray(labels, dtype=np.int32),
+        "centers": np.asarray(centers, dtype=np.float32),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(bundle_dir, f"{name}.npy"), array)
+    write_manifest(bundle_dir, manifest, arrays)
+
+
+def load_results_bundle(
+    results_dir: str, mmap_mode: Optional[str] = "r"
+) -> dict[str, np.ndarray]:
+    """
+    Loads the arrays saved by save_results_bundle(), memory-mapped by default.
+    The responses are not decoded, use decode_strings() with the
+    response_bytes and response_offsets arrays for that.
+    """
+    bundle_dir = os.path.join(results_dir, BUNDLE_DIR)
+    with open(os.path.join(bundle_dir, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["version"] != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported results bundle version: {manifest['version']}")
+    return {
+        name: np.load(os.path.join(bundle_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        for name in manifest["arrays"]
+    }
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Optional
+
+import numpy as np
+from loguru import logger
+
+# bump when the outputs of a stage change, so old entries are never reused
+STAGE_CACHE_VERSION = 2
+META_FILE = "meta.json"
+
+
+def stage_key(stage: str, upstream_key: Optional[str], settings: dict[str, Any]) -> str:
+    """
+    Key of the outputs of a stage: a hash of the key of the stage it consumes
+    and of every setting it depends on. Changing a setting therefore
+    invalidates its stage and all stages downstream of it.
+    """
+    payload = json.dumps(
+        {
+            "version": STAGE_CACHE_VERSION,
+            "stage": stage,
+            "upstream": upstream_key,
+            "settings": settings,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Persistent on-disk store of the outputs of the pipeline stages, so a
+    re-run with changed downstream settings resumes from the first stage
+    whose key changed.
+
+    Every entry is a directory <cache_dir>/<stage>/<key> with the arrays of
+    the stage as .npy files and everything else in meta.json. Entries are
+    written to a temporary directory first, so an interrupted run never
+    leaves a partial entry behind. When the cache grows beyond max_bytes the
+    least recently used entries are evicted on save.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, stage: str, key: str) -> str:
+        return os.path.join(self.dir, stage, key)
+
+    def load(
+        self, stage: str, key: str
+    ) -> Optional[tuple[dict[str, Any], dict[str, np.ndarray]]]:
+        """The metadata and arrays saved for the key, None on a miss."""
+        entry_dir = self.entry_dir(stage, key)
+        meta_file = os.path.join(entry_dir, META_FILE)
+        if not os.path.exists(meta_file):
+            return None
+        try:
+            with open(meta_file, encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(entry_dir, f"{name}.npy"))
+                for name in meta["arrays"]
+            }
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Discarding unreadable stage cache entry {entry_dir}: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        # the modification time of the metadata is the time of last use
+        os.utime(meta_file)
+        logger.debug(f"Stage cache hit: {stage} {key}")
+        return meta["data"], arrays
+
+    def save(
+        self,
+        stage: str,
+        key: str,
+        data: dict[str, Any],
+        arrays: Optional[dict[str, np.ndarray]] = None,
+    ):
+        arrays = arrays or {}
+        entry_dir = self.entry_dir(stage, key)
+        tmp_dir = entry_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"arrays": list(arrays), "data": data}, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        logger.debug(f"Saved stage cache entry: {stage} {key}")
+        self.evict()
+
+    def evict(self):
+        # (last used, size, directory) of every entry
+        entries: list[tuple[float, int, str]] = []
+        for stage in os.listdir(self.dir):
+            stage_dir = os.path.join(self.dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                entry_dir = os.path.join(stage_dir, key)
+                meta_file = os.path.join(entry_dir, META_FILE)
+                if not os.path.exists(meta_file):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, name))
+                    for name in os.listdir(entry_dir)
+                )
+                entries.append((os.path.getmtime(meta_file), size, entry_dir))
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        # the most recently saved entry is never evicted
+        entries.sort()
+        evicted = 0
+        for _, size, entry_dir in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from the stage cache")
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must only be imported once a stage needs them
+HEAVY_MODULES = ["torch", "sentence_transformers", "sklearn", "scipy", "matplotlib"]
+# seconds importing main may take, measured at about 0.35s
+IMPORT_TIME_BUDGET = 1.5
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import main
+
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": list(sys.modules)}))
+"""
+
+
+def import_main() -> dict:
+    # a fresh interpreter, so nothing is imported yet
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        cwd=PYTHON_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_main_does_not_import_heavy_modules():
+    modules = set(import_main()["modules"])
+    loaded = [
+        name
+        for name in HEAVY_MODULES
+        if any(m == name or m.startswith(name + ".") for m in modules)
+    ]
+    assert not loaded, f"importing main loaded {loaded}"
+
+
+def test_main_import_time_budget():
+    seconds = import_main()["seconds"]
+    assert (
+        seconds < IMPORT_TIME_BUDGET
+    ), f"importing main took {seconds:.2f}s, budget {IMPORT_TIME_BUDGET}s"